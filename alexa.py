@@ -1,17 +1,20 @@
-import boto3
 import json
 import os
 import sys
+import time
+from collections import OrderedDict
 from datetime import date
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
+import dynamo
+from metrics import metrics, log, dump
+from snapshot import Snapshot
+from titles import TitleIndex
 
 HERE = os.path.dirname(os.path.realpath(__file__))
 SITE_PKGS = os.path.join(HERE, 'site-packages')
 sys.path.append(SITE_PKGS)
 
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
+# boto3, botocore, elasticsearch and requests_aws4auth are imported on first
+# use so intents that don't need a backend (launch, help, stop) start faster
 # from aws_xray_sdk.core import xray_recorder
 # from aws_xray_sdk.core import patch_all
 
@@ -19,14 +22,51 @@ from requests_aws4auth import AWS4Auth
 ES_HOST = os.environ['esdomain']
 DDB_TABLE = os.environ['ddb']
 LATEST_INDEX = os.environ['latest_index']
-
-# Credentials to be used when adding to Elasticsearch index
-credentials = boto3.Session().get_credentials()
-awsauth = AWS4Auth(credentials.access_key, 
-                    credentials.secret_key, 
-                    boto3.session.Session().region_name,
-                    'es', session_token=credentials.token)
-                    
+EPISODE_INDEX = os.environ['episode_index']
+# Key of the item maintained by feed.main with the latest episodes
+LATEST_KEY = '__latest_episodes__'
+# Elasticsearch index (or alias) written by feed.main
+ES_INDEX = 'hbrfeedcast'
+# Layout of the documents written by feed.main, 'entity' or 'episode'. The
+# episode layout holds the description and entities of an episode in one
+# document of ES_EPISODE_INDEX.
+ES_LAYOUT = os.environ.get('eslayout', 'entity')
+ES_EPISODE_INDEX = 'hbrepisodes'
+# Number of episodes returned by a search
+SEARCH_SIZE = 3
+# Age of an episode halving its rank in entity searches
+RECENCY_SCALE = os.environ.get('recency_scale', '730d')
+# Key of the item updated by feed.main whenever new episodes are ingested
+GENERATION_KEY = '__ingest_generation__'
+# Key of the title search index maintained by feed.main, and the lowest
+# score, from 0 to 1, of a title matching the spoken one
+TITLE_SEARCH_KEY = '__title_search__'
+TITLE_MIN_SCORE = float(os.environ.get('title_min_score', 0.5))
+# Optional S3 bucket holding the snapshot of the catalog published by
+# feed.main. The read intents are answered from it, in the container, and
+# only use DynamoDB and Elasticsearch when it has no answer.
+SNAPSHOT_BUCKET = os.environ.get('snapshotbucket')
+SNAPSHOT_KEY = 'snapshot.json.gz'
+
+# Search responses are cached in the container for CACHE_TTL seconds, which
+# defaults to the schedule of feed.main. Set cache_size to 0 to disable it.
+CACHE_SIZE = int(os.environ.get('cache_size', 128))
+CACHE_TTL = int(os.environ.get('cache_ttl', 24 * 60 * 60))
+# How often, in seconds, to check if feed.main ingested new episodes and drop
+# the cache if it did. Set to 0 to never check.
+CACHE_GENERATION_CHECK = int(os.environ.get('cache_generation_check', 300))
+# Optional DynamoDB table shared by every container, keyed on 'key'
+CACHE_TABLE = os.environ.get('cache_table')
+# Intents whose responses are cached, with the slot they depend on
+CACHED_INTENTS = {
+    'GetEpisodeByTitle': 'episode_title',
+    'PersonSearch': 'episode_person',
+    'IdeaSearch': 'episode_idea'
+}
+
+# Clients reused across intents and warm invocations of this container,
+# see __get_table() and __get_cluster()
+clients = {}
 
 """ General global configuation """
 SKILL_NAME = 'HBR Feedcast'
@@ -49,12 +89,17 @@ def main(event, context):
     event -- The details of this event
     context -- Other parameters associated to this event
     """
-    if event['request']['type'] == 'LaunchRequest':
-        return on_launch(event['request'])
-    elif event['request']['type'] == 'IntentRequest':
-        return on_intent(event['request'], event['session'])
-    elif event['request']['type'] == 'SessionEndedRequest':
-        return on_session_ended()
+    request = event['request']
+    metrics.start('alexa', request.get('intent', {}).get('name', request['type']))
+    try:
+        if event['request']['type'] == 'LaunchRequest':
+            return on_launch(event['request'])
+        elif event['request']['type'] == 'IntentRequest':
+            return on_intent(event['request'], event['session'])
+        elif event['request']['type'] == 'SessionEndedRequest':
+            return on_session_ended()
+    finally:
+        metrics.emit()
 
 
 def on_intent(request, session):
@@ -68,9 +113,16 @@ def on_intent(request, session):
     """
 
     intent_name = request['intent']['name']
-    print(json.dumps(request))
+    dump('request', request)
+
+    if intent_name in CACHED_INTENTS and CACHE_SIZE > 0:
+        slot = request['intent']['slots'][CACHED_INTENTS[intent_name]]
+        return cached_response(intent_name, slot.get('value', ''),
+                               lambda: dispatch_intent(intent_name, request))
+    return dispatch_intent(intent_name, request)
 
-    # process the intents
+def dispatch_intent(intent_name, request):
+    """Calls the function fullfilling the intent and returns its response"""
     if intent_name == 'GetLatestEpisodes':
         return get_latest_episodes()
     elif intent_name == 'GetEpisodeByNumber':
@@ -98,56 +150,73 @@ def get_latest_episodes():
     
     Returns the titles of the last 3 published episodes
     """
-    table = __get_table()
+    snapshot = __get_snapshot()
     try:
-        items = table.scan(IndexName=LATEST_INDEX)
-    except ClientError as error:
+        if snapshot is not None:
+            sorted_episodes = snapshot.latest(3)
+        else:
+            sorted_episodes = __get_latest_from_table()
+    except __client_error() as error:
         print('Problem getting latest episodes: {}'.format(error))
         return speech_response('Sorry, I\'m having trouble connecting to my '
                                'services. Please try again later.', True)
     else:
         speech_output = 'I found the following episodes. '
-        sorted_episodes = sorted(items['Items'], key=lambda k: k['pub_date'], reverse=True) 
         for item in sorted_episodes[:3]:
             episode = item['title'].split(':')[0]   # Gets episode number from title
             title = item['title'].split(':')[1]     # Gets the title
             speech_output += 'Episode {}, {}. '.format(episode, title)
         speech_output += 'Anything else today?'
         card_display = speech_output
-        print(speech_output)
+        log(speech_output)
         return response(speech_response_with_card(SKILL_NAME, speech_output, 
                                                   card_display, False))
 
+def __get_latest_from_table():
+    """Returns the latest episodes saved by feed.main, newest first"""
+    table = __get_table()
+    latest = table.get_item(Key={'title': LATEST_KEY})
+    if 'Item' in latest:
+        return latest['Item']['episodes']
+    # feed.main hasn't saved the latest episodes yet
+    items = dynamo.items(table.scan, IndexName=LATEST_INDEX)
+    return sorted(items, key=lambda k: k['pub_date'], reverse=True)
+
 def get_episode_by_number(slots):
     """Called from -> GetEpisodeByNumber
     
     Returns the description of an episode by the episode number
     """
-    print('In function get_episode_by_number({})'.format(json.dumps(slots)))
+    from boto3.dynamodb.conditions import Key
+    log('In function get_episode_by_number({})'.format(json.dumps(slots)))
     episode = str(slots['episode_id']['value'])
-    table = __get_table()
+    snapshot = __get_snapshot()
     try:
-        episodes = table.scan(
-            IndexName=LATEST_INDEX,
-            FilterExpression=Attr('title').begins_with(episode + ':')
-        )
-    except ClientError as error:
-        print('Problem scanning DynamoDB: {}'.format(error))
-        # TO DO: Return error response here
+        item = None
+        if snapshot is not None and snapshot.episode(episode) is not None:
+            item = {'content': snapshot.episode(episode)}
+        if item is None:
+            table = __get_table()
+            item = dynamo.first(
+                table.query,
+                IndexName=EPISODE_INDEX,
+                KeyConditionExpression=Key('episode').eq(episode),
+                **dynamo.projection('content')
+            )
+    except __client_error() as error:
+        print('Problem querying DynamoDB: {}'.format(error))
+        speech_output = ('Sorry, I\'m having trouble connecting to my '
+                         'services. ')
     else:
-        if episodes['Count'] == 1:
-            episode_details = get_episode_details(episodes['Items'][0]['title'])
-            if not episode_details:
-                speech_output = ('I\'m sorry, I couldn\'t find details on that '
-                                 'episode. ')
-            else:
-                speech_output = 'I found the following on episode {}. {} '.format(episode, episode_details)
+        if item is not None and 'content' in item:
+            episode_details = item['content']
+            speech_output = 'I found the following on episode {}. {} '.format(episode, episode_details)
         else:
             speech_output = ('I\'m sorry, I couldn\'t find details on that '
                                  'episode. ')
     speech_output += 'Anything else today?'
     card_display = speech_output
-    print(speech_output)
+    log(speech_output)
     return response(speech_response_with_card(SKILL_NAME, speech_output, 
                                               card_display, False))
 
@@ -156,31 +225,53 @@ def get_episode_by_title(slots):
     
     Returns the description of an episode by the title
     """
-    print('In function get_episode_by_title({})'.format(json.dumps(slots)))
+    from boto3.dynamodb.conditions import Attr
+    log('In function get_episode_by_title({})'.format(json.dumps(slots)))
     title = str(slots['episode_title']['value'])
+    snapshot = __get_snapshot()
+    matched = match_title(title)
+    if matched:
+        episode_details = None
+        if snapshot is not None:
+            episode_details = snapshot.content(matched)
+        if not episode_details:
+            episode_details = get_episode_details(matched)
+        if episode_details:
+            speech_output = 'I found the following on episode {}. {} '.format(
+                matched.split(':')[0], episode_details)
+            speech_output += 'Anything else today?'
+            card_display = speech_output
+            return response(speech_response_with_card(SKILL_NAME, speech_output,
+                                                      card_display, False))
+    if ES_LAYOUT == 'episode':
+        return get_episode_by_title_from_cluster(title)
     try:
         table = __get_table()
-        episodes = table.scan(
+        # Reads page by page until a title matches
+        found = dynamo.first(
+            table.scan,
             IndexName=LATEST_INDEX,
-            FilterExpression=Attr('title').contains(title.title())
+            FilterExpression=Attr('title').contains(title.title()),
+            **dynamo.projection('title')
         )
-    except ClientError as error:
+    except __client_error() as error:
         print('Problem scanning DynamoDB: {}'.format(error))
         # TO DO: Return response here
     else:
-        if episodes['Count'] == 0:
+        if found is None:
             # Search cluster as fallback
-            print('Searching elasticsearch cluster')
-            es = Elasticsearch(
-                hosts = [{'host': ES_HOST, 'port': 443}],
-                http_auth = awsauth,
-                use_ssl = True,
-                verify_certs = True,
-                connection_class = RequestsHttpConnection
+            log('Searching elasticsearch cluster')
+            es = __get_cluster()
+            search = es.search(
+                index=ES_INDEX,
+                body={
+                    'size': 1,
+                    '_source': ['title'],
+                    'query': {'match': {'title': title}}
+                }
             )
-            #print(json.dumps(es.search(q=title)))
-            search = es.search(q=title)
-            if search['hits']:
+            episode_details = False
+            if search['hits']['hits']:
                 episode_details = get_episode_details(
                     search['hits']['hits'][0]['_source']['title']
                 )
@@ -192,16 +283,16 @@ def get_episode_by_title(slots):
                 speech_output = 'I found the following on episode {}. {} '.format(search['hits']['hits'][0]['_source']['title'], episode_details)
         else:
             # Look up the episode in the table
-            episode_details = get_episode_details(episodes['Items'][0]['title'])
+            episode_details = get_episode_details(found['title'])
             if not episode_details:
                 speech_output = ('I\'m sorry, I couldn\'t find details on that '
                                  'episode. ')
             else:
-                episode = episodes['Items'][0]['title'].split(':')[0]
+                episode = found['title'].split(':')[0]
                 speech_output = 'I found the following on episode {}. {} '.format(episode, episode_details)
     speech_output += 'Anything else today?'
     card_display = speech_output
-    print(json.dumps(episodes))
+    dump('episode', found)
     return response(speech_response_with_card(SKILL_NAME, speech_output, 
                                           card_display, False))
         
@@ -211,63 +302,356 @@ def search_episodes_by_person(slots):
     
     Returns episodes that may have a specific person in them
     """
-    print('In function search_episodes_by_person({})'.format(json.dumps(slots)))
+    log('In function search_episodes_by_person({})'.format(json.dumps(slots)))
     person = str(slots['episode_person']['value'])
-    print('Searching elasticsearch cluster')
-    es = __get_cluster()
-    results = es.search(q=person)
-    print(json.dumps(results))
-    if results['hits'] and len(results['hits']['hits']) > 0:
+    log('Searching elasticsearch cluster')
+    results, total = search_entities(person, True)
+    dump('results', results)
+    if total > 1:
+        speech_output = '{} episodes feature {}, including {}. '.format(
+            total, results[0]['Text'], list_titles(results))
+    elif total == 1:
         speech_output = 'I found an episode with {} titled {} '.format(
-            results['hits']['hits'][0]['_source']['Text'],
-            results['hits']['hits'][0]['_source']['title']
+            results[0]['Text'],
+            results[0]['title']
         )
     else:
         speech_output = 'I didn\'t find any episodes with {}. '.format(person)
     speech_output += 'Anything else today?'
     card_display = speech_output
-    # print(json.dumps(episodes))
     return response(speech_response_with_card(SKILL_NAME, speech_output, 
                                           card_display, False))
 
 def search_episodes_by_idea(slots):
     """Called from -> IdeaSearch
     
-    Returns episodes that may have a specific person in them
+    Returns episodes that may be about a specific idea
     """
-    print('In function search_episodes_by_idea({})'.format(json.dumps(slots)))
+    log('In function search_episodes_by_idea({})'.format(json.dumps(slots)))
     person = str(slots['episode_idea']['value'])
-    print('Searching elasticsearch cluster')
-    es = __get_cluster()
-    results = es.search(q=person)
-    print(json.dumps(results))
-    if results['hits'] and len(results['hits']['hits']) > 0:
+    log('Searching elasticsearch cluster')
+    results, total = search_entities(person, False)
+    dump('results', results)
+    if total > 1:
+        speech_output = 'I found {} episodes about {}, including {}. '.format(
+            total, results[0]['Text'], list_titles(results))
+    elif total == 1:
         speech_output = 'I found an episode about {} titled {} '.format(
-            results['hits']['hits'][0]['_source']['Text'],
-            results['hits']['hits'][0]['_source']['title']
+            results[0]['Text'],
+            results[0]['title']
         )
     else:
         speech_output = 'I didn\'t find any episodes about {}. '.format(person)
     speech_output += 'Anything else today?'
     card_display = speech_output
-    # print(json.dumps(episodes))
     return response(speech_response_with_card(SKILL_NAME, speech_output, 
                                           card_display, False))
 
+def get_episode_by_title_from_cluster(title):
+    """Returns the description of an episode by the title, answered from a
+    single search of the episode index"""
+    log('Searching elasticsearch cluster')
+    es = __get_cluster()
+    search = es.search(
+        index=ES_EPISODE_INDEX,
+        body={
+            'size': 1,
+            '_source': ['title', 'description'],
+            'query': {'match': {'title': title}}
+        }
+    )
+    if search['hits']['hits']:
+        episode = search['hits']['hits'][0]['_source']
+        speech_output = 'I found the following on episode {}. {} '.format(
+            episode['title'], episode['description'])
+    else:
+        speech_output = ('I\'m sorry, I couldn\'t find details on that '
+                         'episode. ')
+    speech_output += 'Anything else today?'
+    card_display = speech_output
+    return response(speech_response_with_card(SKILL_NAME, speech_output, 
+                                          card_display, False))
+
+def search_entities(text, person):
+    """Searches the entities matching text, either people or anything but
+    people, and groups them by episode. Episodes are ranked by the score of
+    their best entity and how recent they are. Returns up to SEARCH_SIZE
+    episodes as dicts with the entity Text and the episode title, and the
+    number of episodes matching. The snapshot is searched first, the
+    cluster only when it has no match."""
+    snapshot = __get_snapshot()
+    if snapshot is not None:
+        results, total = snapshot.search(text, person, SEARCH_SIZE)
+        if results:
+            return results, total
+    try:
+        return __search_cluster(text, person)
+    except Exception as error:
+        # An index created before its template has published mapped as
+        # text, the decay is dropped for the life of the container
+        if getattr(error, 'status_code', None) != 400 or \
+                not clients.get('recency', True):
+            raise
+        print('Searching without the recency decay: {}'.format(error))
+        clients['recency'] = False
+        return __search_cluster(text, person)
+
+def __search_cluster(text, person):
+    """Runs the search of search_entities() on the cluster"""
+    es = __get_cluster()
+    if ES_LAYOUT == 'episode':
+        query = __entity_query(text, 'entities.', person)
+        results = es.search(
+            index=ES_EPISODE_INDEX,
+            body={
+                'size': SEARCH_SIZE,
+                '_source': ['title'],
+                'query': __recent_first({
+                    'nested': {
+                        'path': 'entities',
+                        'score_mode': 'max',
+                        'query': {
+                            'function_score': {
+                                'query': query,
+                                'field_value_factor': {
+                                    'field': 'entities.Score',
+                                    'missing': 1
+                                }
+                            }
+                        },
+                        'inner_hits': {'size': 1}
+                    }
+                })
+            }
+        )
+        return [{
+            'Text': hit['inner_hits']['entities']['hits']['hits'][0]['_source']['Text'],
+            'title': hit['_source']['title']
+        } for hit in results['hits']['hits']], results['hits']['total']
+    # One hit per episode, the best entity of each
+    results = es.search(
+        index=ES_INDEX,
+        body={
+            'size': SEARCH_SIZE,
+            '_source': ['Text', 'title'],
+            'query': __recent_first({
+                'function_score': {
+                    'query': __entity_query(text, '', person),
+                    'field_value_factor': {'field': 'Score', 'missing': 1}
+                }
+            }),
+            'collapse': {'field': 'title.keyword'},
+            'aggs': {'episodes': {'cardinality': {'field': 'title.keyword'}}}
+        }
+    )
+    hits = results['hits']['hits']
+    total = results.get('aggregations', {}).get('episodes', {}).get(
+        'value', len(hits))
+    return [hit['_source'] for hit in hits], max(total, len(hits))
+
+def __recent_first(query):
+    """Returns the query with its scores decayed by the age of the episode,
+    halving every RECENCY_SCALE, unless published isn't a date in the
+    index"""
+    if not clients.get('recency', True):
+        return query
+    return {
+        'function_score': {
+            'query': query,
+            'gauss': {
+                'published': {
+                    'origin': 'now',
+                    'scale': RECENCY_SCALE,
+                    'decay': 0.5
+                }
+            }
+        }
+    }
+
+def list_titles(results):
+    """Returns the episode titles of the results to be read out, as in
+    'A, B and C'"""
+    titles = [result['title'] for result in results]
+    if len(titles) == 1:
+        return titles[0]
+    return '{} and {}'.format(', '.join(titles[:-1]), titles[-1])
+
+def __entity_query(text, prefix, person):
+    """Returns the query matching the entities with text, prefix being the
+    path of the entity fields"""
+    is_person = {'term': {prefix + 'Type': 'PERSON'}}
+    return {
+        'bool': {
+            'must': {
+                'match': {prefix + 'Text': {'query': text, 'operator': 'and'}}
+            },
+            'filter': is_person if person else {'bool': {'must_not': is_person}}
+        }
+    }
+
+"""Response cache"""
+
+
+class ResponseCache(object):
+    """In memory LRU cache of skill responses. Entries expire ttl seconds
+    after they are added and the least recently used entry is evicted once
+    the cache holds size entries."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = None
+        self.checked = 0
+
+    def get(self, key):
+        """Returns the response cached for key, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        cached, expires = entry
+        if expires < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return cached
+
+    def put(self, key, cached):
+        """Caches the response for key"""
+        self.entries[key] = (cached, time.time() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every cached response"""
+        self.entries.clear()
+
+
+# Lives as long as the container, so warm invocations share it
+response_cache = ResponseCache(CACHE_SIZE, CACHE_TTL)
+
+
+def cached_response(intent_name, value, fullfill):
+    """Returns the cached response of the intent for this slot value. On a
+    miss, the shared cache table is tried before calling fullfill, and the
+    response is cached in both."""
+    key = '{}:{}'.format(intent_name, normalize_slot_value(value))
+    __check_generation()
+    cached = response_cache.get(key)
+    if cached is not None:
+        log('Response cache hit for {}'.format(key))
+        return cached
+    cached = __get_shared_response(key)
+    if cached is None:
+        cached = fullfill()
+        __put_shared_response(key, cached)
+    response_cache.put(key, cached)
+    return cached
+
+def normalize_slot_value(value):
+    """Returns the slot value in lower case with single spaces"""
+    return ' '.join(str(value).lower().split())
+
+def __check_generation():
+    """Drops the response cache if feed.main ingested new episodes since
+    the last check. Checks at most every CACHE_GENERATION_CHECK seconds."""
+    now = time.time()
+    if not CACHE_GENERATION_CHECK or \
+            now - response_cache.checked < CACHE_GENERATION_CHECK:
+        return
+    response_cache.checked = now
+    try:
+        item = __get_table().get_item(Key={'title': GENERATION_KEY})
+    except __client_error() as error:
+        print('Problem getting ingest generation: {}'.format(error))
+        return
+    generation = item.get('Item', {}).get('generation')
+    if generation != response_cache.generation:
+        if response_cache.generation is not None:
+            print('New ingest generation {}, dropping cache'.format(generation))
+            response_cache.clear()
+        response_cache.generation = generation
+
+def __get_shared_response(key):
+    """Returns the response cached for key in the shared cache table, or
+    None if there is no table, no response or it is from another
+    generation"""
+    if not CACHE_TABLE:
+        return None
+    try:
+        item = __get_cache_table().get_item(Key={'key': key})
+    except __client_error() as error:
+        print('Problem reading the shared cache: {}'.format(error))
+        return None
+    if 'Item' not in item:
+        return None
+    item = item['Item']
+    if item['expires'] < time.time() or \
+            item.get('generation') != response_cache.generation:
+        return None
+    return json.loads(item['response'])
+
+def __put_shared_response(key, cached):
+    """Caches the response for key in the shared cache table"""
+    if not CACHE_TABLE:
+        return
+    item = {
+        'key': key,
+        'response': json.dumps(cached),
+        'expires': int(time.time() + CACHE_TTL)
+    }
+    if response_cache.generation:
+        item['generation'] = response_cache.generation
+    try:
+        __get_cache_table().put_item(Item=item)
+    except __client_error() as error:
+        print('Problem writing the shared cache: {}'.format(error))
+
 """Intent helper functions"""
 
+def match_title(title):
+    """Returns the title of the episode best matching the spoken title in
+    the title search index, or None if none scores TITLE_MIN_SCORE"""
+    matches = __get_title_index().match(title, 1, TITLE_MIN_SCORE)
+    log('Title matches for {}: {}'.format(title, matches))
+    return matches[0][0] if matches else None
+
+def __get_title_index():
+    """Returns the title search index, from the snapshot if there is one,
+    otherwise loading it once per container and again whenever feed.main
+    ingested new episodes. Returns an empty index if feed.main hasn't saved
+    it yet."""
+    snapshot = __get_snapshot()
+    if snapshot is not None:
+        return snapshot.titles
+    generation = response_cache.generation
+    if 'titles' not in clients or \
+            clients.get('titles_generation') != generation:
+        try:
+            item = __get_table().get_item(Key={'title': TITLE_SEARCH_KEY})
+        except __client_error() as error:
+            print('Problem getting title search index: {}'.format(error))
+            return TitleIndex()
+        if 'Item' in item:
+            clients['titles'] = TitleIndex.loads(item['Item']['index'].value)
+        else:
+            clients['titles'] = TitleIndex()
+        clients['titles_generation'] = generation
+    return clients['titles']
+
 def get_episode_details(title):
     """Returns the details of an episode by the title"""
-    print('Getting details for episode {}'.format(title))
+    from boto3.dynamodb.conditions import Key
+    log('Getting details for episode {}'.format(title))
     try:
-        ddb = boto3.resource('dynamodb')
-        table = ddb.Table(DDB_TABLE)
+        table = __get_table()
         details = table.query(
             KeyConditionExpression=Key('title').eq(title),
             ProjectionExpression='content',
             Limit=1
         )
-    except ClientError as error:
+    except __client_error() as error:
         print('Problem getting content for episode: {}'.format(error))
         return False
     else:
@@ -277,20 +661,95 @@ def get_episode_details(title):
             print('No results returned from DynamoDB')
             return False
 
+def __get_snapshot():
+    """Returns the snapshot published by feed.main, loading it once per
+    container and again whenever feed.main ingested new episodes. Returns
+    None without a snapshot bucket, or when the snapshot can't be loaded or
+    is older than the ingest generation, so the intents use DynamoDB and
+    Elasticsearch instead."""
+    if not SNAPSHOT_BUCKET:
+        return None
+    __check_generation()
+    generation = response_cache.generation
+    if 'snapshot' in clients and \
+            clients.get('snapshot_generation') == generation:
+        return clients['snapshot']
+    if 's3' not in clients:
+        import boto3
+        clients['s3'] = metrics.instrument(boto3.client('s3'))
+    try:
+        item = clients['s3'].get_object(Bucket=SNAPSHOT_BUCKET,
+                                        Key=SNAPSHOT_KEY)
+        snapshot = Snapshot.loads(item['Body'].read())
+    except __client_error() as error:
+        print('Problem loading snapshot: {}'.format(error))
+        if error.response['Error']['Code'] != 'NoSuchKey':
+            # Tried again on the next request
+            return None
+        snapshot = None
+    else:
+        log('Loaded snapshot {} of {} episodes'.format(snapshot.version,
+                                                       len(snapshot)))
+        if generation is not None and snapshot.version < generation:
+            # feed.main couldn't publish it for the last ingest
+            print('Snapshot {} is older than generation {}, skipped'.format(
+                snapshot.version, generation))
+            snapshot = None
+    clients['snapshot'] = snapshot
+    clients['snapshot_generation'] = generation
+    return snapshot
+
+def __client_error():
+    """Returns the ClientError of botocore. The except clauses calling it
+    only run once a call has failed, so botocore is imported with boto3."""
+    from botocore.exceptions import ClientError
+    return ClientError
+
 def __get_table():
-    ddb = boto3.resource('dynamodb')
-    table = ddb.Table(DDB_TABLE)
-    return table
+    """Returns the DynamoDB table, creating the resource once per container"""
+    if 'table' not in clients:
+        import boto3
+        ddb = boto3.resource('dynamodb')
+        clients['table'] = ddb.Table(DDB_TABLE)
+        metrics.instrument(clients['table'].meta.client)
+    return clients['table']
+
+def __get_cache_table():
+    """Returns the shared cache table, creating the resource once per
+    container"""
+    if 'cache_table' not in clients:
+        import boto3
+        ddb = boto3.resource('dynamodb')
+        clients['cache_table'] = ddb.Table(CACHE_TABLE)
+        metrics.instrument(clients['cache_table'].meta.client)
+    return clients['cache_table']
 
 def __get_cluster():
-    es = Elasticsearch(
-        hosts = [{'host': ES_HOST, 'port': 443}],
-        http_auth = awsauth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
-    return es
+    """Returns the Elasticsearch client, creating it once per container. The
+    client is created again whenever the credentials used to sign requests
+    have been refreshed, so warm containers never sign with expired
+    tokens."""
+    if 'session' not in clients:
+        import boto3
+        clients['session'] = boto3.Session()
+    session = clients['session']
+    credentials = session.get_credentials().get_frozen_credentials()
+    if clients.get('es_credentials') != credentials:
+        from elasticsearch import Elasticsearch, RequestsHttpConnection
+        from requests_aws4auth import AWS4Auth
+        awsauth = AWS4Auth(credentials.access_key, 
+                           credentials.secret_key, 
+                           session.region_name,
+                           'es', session_token=credentials.token)
+        clients['es'] = metrics.instrument_es(Elasticsearch(
+            hosts = [{'host': ES_HOST, 'port': 443}],
+            http_auth = awsauth,
+            use_ssl = True,
+            verify_certs = True,
+            connection_class = RequestsHttpConnection
+        ))
+        clients['es_credentials'] = credentials
+    return clients['es']
 
 def get_slot_id(slot):
     """Verifies that a known ID is in this slot. If the ID
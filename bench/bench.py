@@ -0,0 +1,319 @@
+"""Benchmarks feed.main and alexa.main against local stand-ins for every
+service: a generated RSS feed served over HTTP, DynamoDB from moto, a fake
+Comprehend client and a stub Elasticsearch server (see bench/stubs.py).
+
+feed.main is run three times: a backfill into an empty table with
+event.json, a catch-up run over the rest of the archive and the steady state
+run with event.json that follows. Then every intent of alexa.json is sent
+to alexa.main repeatedly. The report holds the wall time and requests per
+service of each feed.main run, and the p50/p95 latency of each intent.
+
+    python bench/bench.py --episodes 300 --comprehend-latency 0.05
+    python bench/bench.py --check
+
+With --check the results are compared with bench/thresholds.json and the
+exit status is 1 if any of them regressed. With --snapshot feed.main
+publishes the snapshot of the catalog and the intents are answered from
+it. Requires the packages of bench/requirements.txt.
+"""
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bench.events import ROOT, intent_event, intent_events
+from bench.stubs import FakeComprehend, RequestCounter, StubElasticsearch, \
+    serve_feed, write_feed
+
+THRESHOLDS = os.path.join(HERE, 'thresholds.json')
+TABLE = 'FeedDb'
+ANALYSIS_TABLE = 'AnalysisDb'
+SNAPSHOT_BUCKET = 'bench-snapshot'
+FEED_RUNS = ('backfill', 'archive', 'steady')
+MOTO_LOCK = threading.Lock()
+
+
+def percentile(values, percent):
+    """Returns the nearest rank percentile of values"""
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+def mock_aws():
+    """Returns the moto context manager mocking DynamoDB. moto isn't thread
+    safe, so the requests it serves are serialized."""
+    try:
+        from moto import mock_aws
+    except ImportError:
+        from moto import mock_dynamodb as mock_aws
+    from moto.core.botocore_stubber import BotocoreStubber
+    call = BotocoreStubber.__call__
+    if not getattr(call, 'serialized', False):
+        def serialized(self, *args, **kwargs):
+            with MOTO_LOCK:
+                return call(self, *args, **kwargs)
+        serialized.serialized = True
+        BotocoreStubber.__call__ = serialized
+    return mock_aws()
+
+
+def local_env(feed_url, cache_size=0):
+    """Returns the environment variables of the handlers run against the
+    local stand-ins"""
+    return {
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_SESSION_TOKEN': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'feedurl': feed_url,
+        'ddb': TABLE,
+        'minscore': '95',
+        'esdomain': '127.0.0.1',
+        'latest_index': 'LatestEpisodes',
+        'episode_index': 'EpisodeNumber',
+        'cache_size': str(cache_size),
+        # moto has no provisioned capacity for feed.main to be paced at
+        'rcu': '100000',
+        'wcu': '100000'
+    }
+
+
+def create_table():
+    """Creates the FeedDb table as defined in serverless.yml"""
+    import boto3
+    throughput = {'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    boto3.client('dynamodb').create_table(
+        TableName=TABLE,
+        AttributeDefinitions=[
+            {'AttributeName': name, 'AttributeType': 'S'}
+            for name in ('title', 'pub_date', 'pub_time', 'episode')
+        ],
+        KeySchema=[{'AttributeName': 'title', 'KeyType': 'HASH'}],
+        ProvisionedThroughput=throughput,
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'LatestEpisodes',
+            'KeySchema': [
+                {'AttributeName': 'pub_date', 'KeyType': 'HASH'},
+                {'AttributeName': 'pub_time', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            'ProvisionedThroughput': throughput
+        }, {
+            'IndexName': 'EpisodeNumber',
+            'KeySchema': [{'AttributeName': 'episode', 'KeyType': 'HASH'}],
+            'Projection': {
+                'ProjectionType': 'INCLUDE',
+                'NonKeyAttributes': ['content']
+            },
+            'ProvisionedThroughput': throughput
+        }]
+    )
+
+
+def create_snapshot_stores():
+    """Creates the analysis cache table and the snapshot bucket"""
+    import boto3
+    boto3.client('dynamodb').create_table(
+        TableName=ANALYSIS_TABLE,
+        AttributeDefinitions=[{'AttributeName': 'digest',
+                               'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'digest', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1,
+                               'WriteCapacityUnits': 1}
+    )
+    boto3.client('s3').create_bucket(Bucket=SNAPSHOT_BUCKET)
+
+
+def count_boto_calls(counter):
+    """Counts every call made through the default boto3 session"""
+    import boto3
+
+    def before_call(model, **kwargs):
+        counter.add(model.service_model.service_name, model.name)
+
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-call', before_call)
+
+
+def run_feed(feed, event, counter):
+    """Runs feed.main once, returns its wall time and requests"""
+    counter.reset()
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        feed.main(dict(event), None)
+    return {
+        'wall_ms': (time.time() - start) * 1000,
+        'requests': counter.services()
+    }
+
+
+def run_intents(alexa, events, repeat):
+    """Sends every event to alexa.main repeat times, returns the latency
+    percentiles of each"""
+    results = {}
+    for name, event in sorted(events.items()):
+        latencies = []
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            for _ in range(repeat):
+                start = time.time()
+                alexa.main(event, None)
+                latencies.append((time.time() - start) * 1000)
+        results[name] = {
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95)
+        }
+    return results
+
+
+def bench_events(titles):
+    """Returns the intent events of alexa.json with slot values that exist
+    in the generated feed"""
+    events = intent_events()
+    number, title = titles[len(titles) // 2].split(': ', 1)
+    events['GetEpisodeByNumber'] = intent_event(
+        'GetEpisodeByNumber', {'episode_id': number})
+    events['GetEpisodeByTitle'] = intent_event(
+        'GetEpisodeByTitle', {'episode_title': title})
+    events['PersonSearch'] = intent_event(
+        'PersonSearch', {'episode_person': 'Paul Levy'})
+    events['IdeaSearch'] = intent_event(
+        'IdeaSearch', {'episode_idea': 'collaboration'})
+    return events
+
+
+def run(args):
+    counter = RequestCounter()
+    workdir = tempfile.mkdtemp()
+    try:
+        feed_path = os.path.join(workdir, 'feed.xml')
+        titles = write_feed(feed_path, args.episodes)
+        feed_server = serve_feed(feed_path, counter)
+        es_stub = StubElasticsearch(counter, args.es_latency)
+        os.environ.update(local_env(feed_server.url, args.cache_size))
+        if args.snapshot:
+            os.environ.update({
+                'analysiscache': ANALYSIS_TABLE,
+                'snapshotbucket': SNAPSHOT_BUCKET
+            })
+        with mock_aws():
+            count_boto_calls(counter)
+            create_table()
+            if args.snapshot:
+                create_snapshot_stores()
+            from elasticsearch import Elasticsearch
+            local_es = Elasticsearch(
+                hosts=[{'host': '127.0.0.1', 'port': es_stub.port}])
+            feed = importlib.import_module('feed')
+            alexa = importlib.import_module('alexa')
+            feed.comprehend = FakeComprehend(counter, args.comprehend_latency)
+            feed.es = local_es
+            # Module level name, so it is not mangled in the intent functions
+            setattr(alexa, '__get_cluster', lambda: local_es)
+
+            with open(os.path.join(ROOT, 'event.json')) as event_file:
+                event = json.load(event_file)
+            if args.max:
+                event['max'] = args.max
+            report = {
+                'backfill': run_feed(feed, event, counter),
+                'archive': run_feed(feed, dict(event, max=args.episodes),
+                                    counter),
+                'steady': run_feed(feed, event, counter)
+            }
+            counter.reset()
+            report['intents'] = run_intents(alexa, bench_events(titles),
+                                             args.repeat)
+            report['intent_requests'] = counter.services()
+        feed_server.shutdown()
+        es_stub.server.shutdown()
+        return report
+    finally:
+        shutil.rmtree(workdir)
+
+
+def print_report(report):
+    for run_name in FEED_RUNS:
+        result = report[run_name]
+        print('feed.main {:<9} {:>9.1f} ms  requests {}'.format(
+            run_name, result['wall_ms'], json.dumps(result['requests'],
+                                                    sort_keys=True)))
+    print('{:<28} {:>9} {:>9}'.format('intent', 'p50 ms', 'p95 ms'))
+    for name, result in sorted(report['intents'].items()):
+        print('{:<28} {:>9.2f} {:>9.2f}'.format(
+            name, result['p50_ms'], result['p95_ms']))
+    print('alexa.main requests {}'.format(
+        json.dumps(report['intent_requests'], sort_keys=True)))
+
+
+def regressions(report, thresholds):
+    """Returns a description of every result over its threshold"""
+    found = []
+    for run_name in FEED_RUNS:
+        limits = thresholds.get(run_name, {})
+        result = report[run_name]
+        if result['wall_ms'] > limits.get('wall_ms', float('inf')):
+            found.append('{} wall time {:.1f} ms > {} ms'.format(
+                run_name, result['wall_ms'], limits['wall_ms']))
+        for service, limit in limits.get('requests', {}).items():
+            count = result['requests'].get(service, 0)
+            if count > limit:
+                found.append('{} {} requests {} > {}'.format(
+                    run_name, service, count, limit))
+    limits = thresholds.get('intents_p95_ms', {})
+    for name, result in report['intents'].items():
+        limit = limits.get(name, limits.get('default', float('inf')))
+        if result['p95_ms'] > limit:
+            found.append('{} p95 {:.1f} ms > {} ms'.format(
+                name, result['p95_ms'], limit))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--episodes', type=int, default=300,
+                        help='Episodes in the generated feed')
+    parser.add_argument('--max', type=int,
+                        help='Override the max of event.json')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Requests sent for each intent')
+    parser.add_argument('--comprehend-latency', type=float, default=0.05,
+                        help='Seconds added to every Comprehend call')
+    parser.add_argument('--es-latency', type=float, default=0.01,
+                        help='Seconds added to every Elasticsearch request')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Response cache size of the skill, 0 disables')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Publish the snapshot of the catalog and '
+                             'answer the intents from it')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    parser.add_argument('--check', action='store_true',
+                        help='Fail if a result is over bench/thresholds.json')
+    args = parser.parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+    if args.check:
+        with open(THRESHOLDS) as thresholds:
+            found = regressions(report, json.load(thresholds))
+        for regression in found:
+            print('REGRESSION {}'.format(regression))
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""Measures the cold start of the Alexa skill. Every intent of alexa.json is
+sent to alexa.main in a fresh Python process, which reports how long the
+import of alexa took and how long the first response took.
+
+Intents that need a backend use the esdomain, ddb, latest_index and
+episode_index environment variables like the Lambda function does, so
+they need AWS credentials and a deployed stack. When the variables aren't
+set, placeholders are used so the intents that don't need a backend still
+answer. With --local every process first ingests a generated feed into the
+stand-ins of bench.py (DynamoDB from moto, a fake Comprehend and a stub
+Elasticsearch server) and the intents are answered from them. The backend
+libraries are then imported before the measurement, their import time is
+added to the first response of the intents that call a backend. The
+standard library modules loaded by the stand-ins are left loaded too, so
+the import of alexa is measured without --local. Use --intents to only
+measure some of them:
+
+    python bench/coldstart.py --intents LaunchRequest AMAZON.HelpIntent
+    python bench/coldstart.py --local
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bench.events import ROOT, intent_events
+
+# Alexa waits 8 seconds for the skill to respond
+RESPONSE_DEADLINE_MS = 8000
+
+# Episodes of the feed ingested with --local
+LOCAL_EPISODES = 30
+
+# Environment of the child process for the variables that aren't set
+PLACEHOLDER_ENV = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'esdomain': '127.0.0.1',
+    'ddb': 'FeedDb',
+    'latest_index': 'LatestEpisodes',
+    'episode_index': 'EpisodeNumber'
+}
+
+# Runs in the fresh process, the event is read from stdin
+CHILD = '''
+import json, sys, time
+event = json.load(sys.stdin)
+local = '--local' in sys.argv
+if local:
+    from bench.coldstart import local_backend
+    backend_import_ms, counter, cluster = local_backend()
+start = time.time()
+import alexa
+imported = time.time()
+if local:
+    setattr(alexa, '__get_cluster', lambda: cluster)
+    counter.reset()
+alexa.main(event, None)
+done = time.time()
+first_response_ms = (done - imported) * 1000
+if local and counter.services():
+    first_response_ms += backend_import_ms
+print('COLDSTART ' + json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_response_ms': first_response_ms
+}))
+'''
+
+
+def local_backend():
+    """Runs in the child process before alexa is imported. Ingests a
+    generated feed with feed.main into the stand-ins of bench.py, which stay
+    up for the intent. Returns the milliseconds taken to import the backend
+    libraries, the counter of the requests made to the
+    stand-ins and the Elasticsearch client of the stub server."""
+    start = time.time()
+    import boto3, elasticsearch, requests_aws4auth
+    backend_import_ms = (time.time() - start) * 1000
+    from bench.bench import count_boto_calls, create_table, local_env, \
+        mock_aws
+    from bench.stubs import FakeComprehend, RequestCounter, \
+        StubElasticsearch, serve_feed, write_feed
+    counter = RequestCounter()
+    workdir = tempfile.mkdtemp()
+    feed_path = os.path.join(workdir, 'feed.xml')
+    write_feed(feed_path, LOCAL_EPISODES)
+    feed_server = serve_feed(feed_path, counter)
+    es_stub = StubElasticsearch(counter)
+    os.environ.update(local_env(feed_server.url))
+    mock_aws().start()
+    count_boto_calls(counter)
+    create_table()
+    cluster = elasticsearch.Elasticsearch(
+        hosts=[{'host': '127.0.0.1', 'port': es_stub.port}])
+    import feed
+    feed.comprehend = FakeComprehend(counter)
+    feed.es = cluster
+    with open(os.path.join(ROOT, 'event.json')) as event_file, \
+            open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        feed.main(json.load(event_file), None)
+    shutil.rmtree(workdir)
+    # The modules shared with alexa are imported again by the measurement
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None) or ''
+        if os.path.dirname(os.path.realpath(path)) == ROOT:
+            del sys.modules[name]
+    return backend_import_ms, counter, cluster
+
+
+def measure(event, local=False):
+    """Sends the event to alexa.main in a new process, answered by the
+    stand-ins of bench.py if local. Returns the import and first response
+    times in milliseconds, or the error raised."""
+    child = subprocess.run(
+        [sys.executable, '-c', CHILD] + (['--local'] if local else []),
+        input=json.dumps(event),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=ROOT,
+        env=dict(PLACEHOLDER_ENV, **os.environ)
+    )
+    for line in reversed(child.stdout.splitlines()):
+        if line.startswith('COLDSTART '):
+            return json.loads(line[len('COLDSTART '):])
+    lines = child.stderr.strip().splitlines()
+    return {'error': lines[-1] if lines else 'exit {}'.format(child.returncode)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--intents', nargs='*',
+                        help='Intents to measure, defaults to all of them')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Cold starts to measure for each intent')
+    parser.add_argument('--local', action='store_true',
+                        help='Answer the intents from the stand-ins of '
+                             'bench.py instead of AWS')
+    args = parser.parse_args()
+    events = intent_events()
+    names = args.intents or sorted(events)
+    print('{:<28} {:>10} {:>16} {:>10}'.format(
+        'intent', 'import ms', 'first resp. ms', 'total ms'))
+    for name in names:
+        results = [measure(events[name], args.local)
+                   for _ in range(args.runs)]
+        errors = [r['error'] for r in results if 'error' in r]
+        if errors:
+            print('{:<28} {}'.format(name, errors[0]))
+            continue
+        import_ms = min(r['import_ms'] for r in results)
+        response_ms = min(r['first_response_ms'] for r in results)
+        total = import_ms + response_ms
+        print('{:<28} {:>10.1f} {:>16.1f} {:>10.1f}{}'.format(
+            name, import_ms, response_ms, total,
+            '  over deadline' if total > RESPONSE_DEADLINE_MS else ''))
+
+
+if __name__ == '__main__':
+    main()
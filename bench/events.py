@@ -0,0 +1,87 @@
+"""Builds Alexa request events for the intents of the skill, using the
+interaction model in alexa.json. Used by the benchmark tools in this
+directory."""
+import json
+import os
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(HERE)
+MODEL = os.path.join(ROOT, 'alexa.json')
+
+# Slot values for the built in slot types, custom types use their first value
+SLOT_VALUES = {
+    'AMAZON.NUMBER': '600',
+    'AMAZON.Person': 'Paul Levy'
+}
+
+
+def load_model(path=MODEL):
+    """Returns the language model of the skill"""
+    with open(path) as model:
+        return json.load(model)['interactionModel']['languageModel']
+
+
+def launch_event():
+    """Returns a LaunchRequest event"""
+    return {
+        'session': __session(),
+        'request': {
+            'type': 'LaunchRequest',
+            'requestId': 'amzn1.echo-api.request.bench',
+            'locale': 'en-US'
+        }
+    }
+
+
+def intent_event(name, slots=None):
+    """Returns an IntentRequest event for the intent, slots being a dict of
+    slot name to spoken value"""
+    return {
+        'session': __session(),
+        'request': {
+            'type': 'IntentRequest',
+            'requestId': 'amzn1.echo-api.request.bench',
+            'locale': 'en-US',
+            'intent': {
+                'name': name,
+                'confirmationStatus': 'NONE',
+                'slots': {
+                    slot: {'name': slot, 'value': value}
+                    for slot, value in (slots or {}).items()
+                }
+            }
+        }
+    }
+
+
+def slot_values(model, slot_type):
+    """Returns the sample values for a slot type of the model"""
+    if slot_type in SLOT_VALUES:
+        return [SLOT_VALUES[slot_type]]
+    for custom in model['types']:
+        if custom['name'] == slot_type:
+            return [value['name']['value'] for value in custom['values']]
+    return []
+
+
+def intent_events(model=None):
+    """Returns a dict of intent name to an event for every intent of the
+    model, with each slot filled with the first sample value of its type"""
+    model = model or load_model()
+    events = {'LaunchRequest': launch_event()}
+    for intent in model['intents']:
+        slots = {}
+        for slot in intent.get('slots', []):
+            values = slot_values(model, slot['type'])
+            slots[slot['name']] = values[0] if values else ''
+        events[intent['name']] = intent_event(intent['name'], slots)
+    return events
+
+
+def __session():
+    return {
+        'new': True,
+        'sessionId': 'amzn1.echo-api.session.bench',
+        'application': {'applicationId': 'amzn1.ask.skill.bench'},
+        'user': {'userId': 'amzn1.ask.account.bench'}
+    }
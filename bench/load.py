@@ -0,0 +1,381 @@
+"""Load tests alexa.main with a mix of intent events sent at a target rate,
+against local stand-ins for DynamoDB (moto) and Elasticsearch (see
+bench/stubs.py) with injected latency and throttling.
+
+Requests are sent open loop: the n-th request is due n / rate seconds after
+the start, whether or not the previous ones are done, and its latency is
+measured from that time so queueing shows up in the results. Each worker
+thread plays one Lambda container, with its own copy of the alexa module
+loaded on its first request, so cold starts and per container clients are
+measured too. --containers bounds them like the concurrency limit of the
+function.
+
+DynamoDB reads and writes are throttled by token buckets refilled at the
+provisioned --rcu and --wcu, with --burst-seconds of unused capacity kept
+as DynamoDB does. Each request consumes one unit. Throttled requests get a
+ProvisionedThroughputExceededException, which botocore retries.
+Elasticsearch rejects --es-reject-rate of the searches with a 429.
+
+The intent mix defaults to the number of sample utterances of each intent
+in alexa.json, override it with --mix:
+
+    python bench/load.py --rate 20 --duration 30
+    python bench/load.py --mix GetEpisodeByTitle=3 PersonSearch=1 --rcu 5
+
+The report holds the throughput, the p50/p95/p99 latency overall and per
+intent, the errors and throttled requests, and the intents with responses
+over the 8 second budget of Alexa. With --check the exit status is 1 when
+any intent breached the budget.
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bench.bench import TABLE, create_table, mock_aws, percentile
+from bench.events import ROOT, intent_event, launch_event, load_model, \
+    slot_values
+from bench.stubs import PEOPLE, FakeComprehend, RequestCounter, \
+    StubElasticsearch, serve_feed, write_feed
+from throttle import TokenBucket
+
+# Alexa waits 8 seconds for the skill to respond
+RESPONSE_BUDGET_MS = 8000
+READ_OPERATIONS = ('GetItem', 'BatchGetItem', 'Query', 'Scan')
+WRITE_OPERATIONS = ('PutItem', 'UpdateItem', 'DeleteItem', 'BatchWriteItem')
+
+
+class _Raw(object):
+    """Raw body of a botocore response built in a before-send handler"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class ProvisionedTable(object):
+    """Injects latency and provisioned capacity throttling into the
+    DynamoDB requests of the default boto3 session. Registered ahead of
+    moto, so throttled requests never reach it."""
+
+    def __init__(self, counter, latency, rcu, wcu, burst_seconds):
+        self.counter = counter
+        self.latency = latency
+        self.buckets = {
+            'read': TokenBucket(rcu, rcu * burst_seconds),
+            'write': TokenBucket(wcu, wcu * burst_seconds)
+        }
+        self.active = False
+
+    def register(self, session):
+        session.events.register_first('before-send.dynamodb', self.before_send)
+
+    def before_send(self, request, event_name, **kwargs):
+        if not self.active:
+            return None
+        operation = event_name.split('.')[-1]
+        self.counter.add('dynamodb', operation)
+        time.sleep(self.latency)
+        if operation in READ_OPERATIONS:
+            bucket = self.buckets['read']
+        elif operation in WRITE_OPERATIONS:
+            bucket = self.buckets['write']
+        else:
+            return None
+        if bucket.take():
+            return None
+        from botocore.awsrequest import AWSResponse
+        self.counter.add('throttled', 'dynamodb')
+        body = json.dumps({
+            '__type': 'com.amazonaws.dynamodb.v20120810#'
+                      'ProvisionedThroughputExceededException',
+            'message': 'The level of configured provisioned throughput for '
+                       'the table was exceeded.'
+        }).encode('utf-8')
+        return AWSResponse(request.url, 400, {
+            'Content-Type': 'application/x-amz-json-1.0',
+            'x-amzn-RequestId': 'load'
+        }, _Raw(body))
+
+
+def intent_mix(model, mix):
+    """Returns a dict of intent name to weight, from the --mix arguments or
+    the number of sample utterances of each intent"""
+    if mix:
+        weights = {}
+        for item in mix:
+            name, _, weight = item.partition('=')
+            weights[name] = float(weight or 1)
+        return weights
+    weights = {'LaunchRequest': 1}
+    for intent in model['intents']:
+        if intent.get('samples'):
+            weights[intent['name']] = len(intent['samples'])
+    return weights
+
+
+def event_source(model, weights, titles, seed):
+    """Returns a function returning a random (intent name, event) of the
+    mix, slots being filled with values of the model or of the generated
+    feed"""
+    rng = random.Random(seed)
+    names = sorted(weights)
+    cumulative = []
+    total = 0
+    for name in names:
+        total += weights[name]
+        cumulative.append(total)
+    slots = {
+        'AMAZON.NUMBER': [title.split(':')[0] for title in titles],
+        'AMAZON.Person': list(PEOPLE),
+        'title': [title.split(': ', 1)[1] for title in titles] +
+                 slot_values(model, 'title')
+    }
+    intents = {intent['name']: intent for intent in model['intents']}
+
+    def next_event():
+        point = rng.random() * total
+        name = next(name for name, bound in zip(names, cumulative)
+                    if point < bound)
+        if name == 'LaunchRequest':
+            return name, launch_event()
+        values = {}
+        for slot in intents[name].get('slots', []):
+            choices = slots.get(slot['type']) or \
+                slot_values(model, slot['type']) or ['']
+            values[slot['name']] = rng.choice(choices)
+        return name, intent_event(name, values)
+
+    return next_event
+
+
+def load_container(number, es_port):
+    """Returns a fresh copy of the alexa module, as a new Lambda container
+    would load it, talking to the stub Elasticsearch server"""
+    from elasticsearch import Elasticsearch
+    spec = importlib.util.spec_from_file_location(
+        'alexa_container_{}'.format(number), os.path.join(ROOT, 'alexa.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    es = Elasticsearch(hosts=[{'host': '127.0.0.1', 'port': es_port}])
+    # Module level name, so it is not mangled in the intent functions
+    setattr(module, '__get_cluster', lambda: es)
+    return module
+
+
+def send_load(args, next_event, es_port):
+    """Sends the requests, returns a list of (intent, latency ms, error)"""
+    local = threading.local()
+    containers = []
+    results = []
+    lock = threading.Lock()
+
+    def handle(name, event, due):
+        if not hasattr(local, 'alexa'):
+            with lock:
+                number = len(containers)
+                containers.append(number)
+            local.alexa = load_container(number, es_port)
+        error = None
+        try:
+            local.alexa.main(event, None)
+        except Exception as exception:
+            error = type(exception).__name__
+        latency = (time.time() - due) * 1000
+        with lock:
+            results.append((name, latency, error))
+
+    total = int(args.rate * args.duration)
+    with ThreadPoolExecutor(max_workers=args.containers) as pool:
+        start = time.time()
+        for sent in range(total):
+            due = start + sent / args.rate
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            name, event = next_event()
+            pool.submit(handle, name, event, due)
+    return results, time.time() - start, len(containers)
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': max(latencies)
+    }
+
+
+def report_results(results, elapsed, containers, counter):
+    """Returns the report of the load test"""
+    intents = {}
+    for name, latency, error in results:
+        intent = intents.setdefault(name, {'latencies': [], 'errors': {}})
+        intent['latencies'].append(latency)
+        if error:
+            intent['errors'][error] = intent['errors'].get(error, 0) + 1
+    report = {
+        'requests': len(results),
+        'elapsed_s': elapsed,
+        'throughput_rps': len(results) / elapsed if elapsed else 0,
+        'containers': containers,
+        'overall': summarize([latency for _, latency, _ in results]),
+        'errors': sum(1 for _, _, error in results if error),
+        'intents': {},
+        'throttled': {k.split('.')[1]: v for k, v in counter.counts.items()
+                      if k.startswith('throttled.')},
+        'requests_per_service': counter.services(),
+        'over_budget': {}
+    }
+    report['requests_per_service'].pop('throttled', None)
+    for name, intent in sorted(intents.items()):
+        summary = summarize(intent['latencies'])
+        summary['errors'] = intent['errors']
+        report['intents'][name] = summary
+        over = sum(1 for latency in intent['latencies']
+                   if latency > RESPONSE_BUDGET_MS)
+        if over:
+            report['over_budget'][name] = over
+    return report
+
+
+def print_report(report):
+    print('{} requests in {:.1f} s, {:.1f} requests/s, {} containers'.format(
+        report['requests'], report['elapsed_s'], report['throughput_rps'],
+        report['containers']))
+    print('{:<24} {:>6} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+        'intent', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'errors'))
+    overall = dict(report['overall'], errors={'total': report['errors']})
+    rows = sorted(report['intents'].items()) + [('overall', overall)]
+    for name, result in rows:
+        print('{:<24} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}  {}'.format(
+            name, result['count'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['max_ms'],
+            json.dumps(result.get('errors', {}), sort_keys=True)))
+    print('requests {}'.format(
+        json.dumps(report['requests_per_service'], sort_keys=True)))
+    print('throttled {}'.format(json.dumps(report['throttled'],
+                                           sort_keys=True)))
+    if report['over_budget']:
+        for name, count in sorted(report['over_budget'].items()):
+            print('{} responses of {} over the {} ms budget'.format(
+                count, name, RESPONSE_BUDGET_MS))
+    else:
+        print('Every response within the {} ms budget'.format(
+            RESPONSE_BUDGET_MS))
+
+
+def run(args):
+    import boto3
+    counter = RequestCounter()
+    workdir = tempfile.mkdtemp()
+    try:
+        feed_path = os.path.join(workdir, 'feed.xml')
+        titles = write_feed(feed_path, args.episodes)
+        feed_server = serve_feed(feed_path, counter)
+        es_stub = StubElasticsearch(counter, args.es_latency)
+        os.environ.update({
+            'AWS_ACCESS_KEY_ID': 'bench',
+            'AWS_SECRET_ACCESS_KEY': 'bench',
+            'AWS_SESSION_TOKEN': 'bench',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'feedurl': feed_server.url,
+            'ddb': TABLE,
+            'minscore': '95',
+            'esdomain': '127.0.0.1',
+            'latest_index': 'LatestEpisodes',
+            'episode_index': 'EpisodeNumber',
+            'cache_size': str(args.cache_size),
+            # moto has no provisioned capacity for feed.main to be paced at
+            'rcu': '100000',
+            'wcu': '100000'
+        })
+        with mock_aws():
+            boto3.setup_default_session()
+            table = ProvisionedTable(counter, args.ddb_latency, args.rcu,
+                                     args.wcu, args.burst_seconds)
+            table.register(boto3.DEFAULT_SESSION)
+            create_table()
+            from elasticsearch import Elasticsearch
+            feed = importlib.import_module('feed')
+            feed.comprehend = FakeComprehend(counter)
+            feed.es = Elasticsearch(
+                hosts=[{'host': '127.0.0.1', 'port': es_stub.port}])
+            model = load_model()
+            next_event = event_source(model, intent_mix(model, args.mix),
+                                      titles, args.seed)
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                feed.main({'backfill': True}, None)
+                counter.reset()
+                table.active = True
+                es_stub.reject_rate = args.es_reject_rate
+                results, elapsed, containers = send_load(args, next_event,
+                                                         es_stub.port)
+        feed_server.shutdown()
+        es_stub.server.shutdown()
+        return report_results(results, elapsed, containers, counter)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=10,
+                        help='Requests sent per second')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to send requests for')
+    parser.add_argument('--containers', type=int, default=10,
+                        help='Maximum number of containers at once')
+    parser.add_argument('--mix', nargs='*',
+                        help='Intent weights as Name=weight')
+    parser.add_argument('--episodes', type=int, default=300,
+                        help='Episodes in the generated feed')
+    parser.add_argument('--rcu', type=float, default=1,
+                        help='Provisioned reads per second of the table')
+    parser.add_argument('--wcu', type=float, default=1,
+                        help='Provisioned writes per second of the table')
+    parser.add_argument('--burst-seconds', type=float, default=300,
+                        help='Seconds of unused capacity kept for bursts')
+    parser.add_argument('--ddb-latency', type=float, default=0.005,
+                        help='Seconds added to every DynamoDB request')
+    parser.add_argument('--es-latency', type=float, default=0.01,
+                        help='Seconds added to every Elasticsearch request')
+    parser.add_argument('--es-reject-rate', type=float, default=0.0,
+                        help='Share of Elasticsearch searches rejected '
+                             'with 429')
+    parser.add_argument('--cache-size', type=int, default=128,
+                        help='Response cache size of the skill, 0 disables')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the intent mix')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    parser.add_argument('--check', action='store_true',
+                        help='Fail if a response is over the 8 second budget')
+    args = parser.parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+    if args.check and report['over_budget']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""Local stand-ins for the services used by the handlers, so they can be
+measured without AWS: a generated RSS feed served over HTTP, a fake
+Comprehend client and a stub Elasticsearch HTTP server. DynamoDB is
+provided by moto in the benchmark runner. Every stand-in counts the
+requests it serves in a RequestCounter."""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+WORDS = ('leadership strategy innovation talent collaboration research '
+         'performance team digital china negotiation risk curiosity science '
+         'business capital clusters sleep automotive industry growth '
+         'marketing customers data decisions managers').split()
+PEOPLE = ('Paul Levy', 'Amy Edmondson', 'Clayton Christensen', 'Rita McGrath',
+          'Michael Porter', 'Linda Hill', 'Francesca Gino', 'Adam Grant')
+
+
+class RequestCounter(object):
+    """Thread safe count of the requests made to each service"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+
+    def add(self, service, operation):
+        with self.lock:
+            self.counts[service] += 1
+            self.counts['{}.{}'.format(service, operation)] += 1
+
+    def services(self):
+        """Returns the count of requests for each service"""
+        return {k: v for k, v in self.counts.items() if '.' not in k}
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+def write_feed(path, episodes, seed=0):
+    """Writes an RSS feed of the given number of episodes, newest first, in
+    the shape of the HBR IdeaCast feed. Returns the titles, oldest first."""
+    rng = random.Random(seed)
+    start = datetime(2006, 8, 31, 13, 10)
+    items = []
+    titles = []
+    for number in range(1, episodes + 1):
+        published = start + timedelta(days=7 * number)
+        title = '{}: {}'.format(number, ' '.join(
+            w.title() for w in rng.sample(WORDS, 4)))
+        person = rng.choice(PEOPLE)
+        description = ('{} talks about {}. '.format(
+            person, ', '.join(rng.sample(WORDS, 5)))) * rng.randint(2, 8)
+        titles.append(title)
+        items.append(
+            '<item><title>{title}</title>'
+            '<guid isPermaLink="false">ideacast-{number}</guid>'
+            '<link>https://hbr.org/podcast/{number}</link>'
+            '<author>HBR IdeaCast</author>'
+            '<pubDate>{published} -0500</pubDate>'
+            '<description>{description}</description>'
+            '<content:encoded>{description}</content:encoded>'
+            '</item>'.format(
+                title=escape(title), number=number,
+                published=published.strftime('%a, %d %b %Y %H:%M:%S'),
+                description=escape(description)))
+    items.reverse()
+    with open(path, 'w') as feed:
+        feed.write(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<rss version="2.0" '
+            'xmlns:content="http://purl.org/rss/1.0/modules/content/">'
+            '<channel><title>HBR IdeaCast</title>'
+            '<link>https://hbr.org/ideacast</link>'
+            '<description>Bench feed</description>{}</channel></rss>'.format(
+                ''.join(items)))
+    return titles
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_feed(path, counter):
+    """Serves the feed at path over HTTP on a free local port, answering
+    conditional requests with 304 when the ETag matches. Returns the server,
+    the feed URL is server.url."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            counter.add('feed', 'GET')
+            with open(path, 'rb') as feed:
+                data = feed.read()
+            etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/rss+xml')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = _start(Handler)
+    server.url += '/feed.xml'
+    return server
+
+
+class FakeComprehend(object):
+    """Stands in for the Comprehend client. Entities are the capitalized
+    word pairs and known topics of the text, and every call sleeps for
+    latency seconds."""
+
+    def __init__(self, counter, latency=0.0):
+        self.counter = counter
+        self.latency = latency
+
+    def detect_entities(self, Text, LanguageCode):
+        self.counter.add('comprehend', 'DetectEntities')
+        time.sleep(self.latency)
+        return {'Entities': self.entities(Text)}
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        self.counter.add('comprehend', 'BatchDetectEntities')
+        time.sleep(self.latency)
+        return {
+            'ResultList': [{'Index': i, 'Entities': self.entities(text)}
+                           for i, text in enumerate(TextList)],
+            'ErrorList': []
+        }
+
+    def entities(self, text):
+        found = []
+        for match in re.finditer(r'[A-Z][a-z]+ [A-Z][a-z]+', text):
+            found.append(self._entity(match, 'PERSON'))
+        for match in re.finditer(r'\b({})\b'.format('|'.join(WORDS)), text):
+            found.append(self._entity(match, 'OTHER'))
+        return found
+
+    @staticmethod
+    def _entity(match, entity_type):
+        return {
+            'Text': match.group(0),
+            'Type': entity_type,
+            'Score': 0.99,
+            'BeginOffset': match.start(),
+            'EndOffset': match.end()
+        }
+
+
+class StubElasticsearch(object):
+    """Minimal Elasticsearch HTTP server keeping documents in memory. Serves
+    _bulk, _search, templates, aliases and index existence checks, sleeping
+    for latency seconds on every request. A share reject_rate of the _bulk
+    and _search requests is rejected with 429, as a cluster whose queues
+    are full would."""
+
+    def __init__(self, counter, latency=0.0, reject_rate=0.0):
+        self.counter = counter
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.lock = threading.Lock()
+        self.documents = defaultdict(list)
+        self.server = _start(self.handler())
+        self.port = self.server.server_address[1]
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_HEAD(self):
+                stub.counter.add('es', 'HEAD')
+                self._reply(200 if stub.documents.get(self._index()) else 404,
+                            None)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PUT(self):
+                self._dispatch('PUT')
+
+            def do_DELETE(self):
+                self._dispatch('DELETE')
+
+            def _dispatch(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                path = self.path.split('?')[0]
+                time.sleep(stub.latency)
+                if path.endswith(('/_bulk', '/_search')) and \
+                        random.random() < stub.reject_rate:
+                    stub.counter.add('throttled', 'es')
+                    self._reply(429, {
+                        'error': {'type': 'es_rejected_execution_exception',
+                                  'reason': 'rejected execution'},
+                        'status': 429
+                    })
+                elif path.endswith('/_bulk'):
+                    stub.counter.add('es', 'bulk')
+                    self._reply(200, stub.bulk(body))
+                elif path.endswith('/_search'):
+                    stub.counter.add('es', 'search')
+                    query = json.loads(body) if body else {}
+                    self._reply(200, stub.search(self._index(), query))
+                else:
+                    stub.counter.add('es', method)
+                    self._reply(200, {'acknowledged': True})
+
+            def _index(self):
+                return self.path.split('?')[0].strip('/').split('/')[0]
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode('utf-8') if payload else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def bulk(self, body):
+        lines = [line for line in body.split('\n') if line]
+        items = []
+        with self.lock:
+            for action, source in zip(lines[::2], lines[1::2]):
+                meta = json.loads(action)['index']
+                self.documents[meta['_index']].append(json.loads(source))
+                items.append({'index': {'_index': meta['_index'],
+                                        'status': 201}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def search(self, index, query):
+        """Returns the documents whose text contains every word of the first
+        match query found in the search body, one per title when the body
+        collapses them"""
+        size = query.get('size', 10)
+        words = _match_text(query).lower().split()
+        hits = []
+        titles = set()
+        for document in list(self.documents.get(index, [])):
+            if 'collapse' in query and document['title'] in titles:
+                continue
+            if 'entities' in document:
+                entities = [e for e in document['entities']
+                            if all(w in e['Text'].lower() for w in words)]
+                if not entities and not all(
+                        w in document['title'].lower() for w in words):
+                    continue
+                hit = {'_source': document, 'inner_hits': {'entities': {
+                    'hits': {'hits': [{'_source': e} for e in entities[:1]]}}}}
+            else:
+                text = '{} {}'.format(document.get('Text', ''),
+                                      document.get('title', ''))
+                if not all(w in text.lower() for w in words):
+                    continue
+                hit = {'_source': document}
+            titles.add(document['title'])
+            if len(hits) < size:
+                hits.append(hit)
+        result = {'took': 1, 'hits': {'total': len(titles), 'hits': hits}}
+        if 'aggs' in query:
+            result['aggregations'] = {'episodes': {'value': len(titles)}}
+        return result
+
+
+def _match_text(query):
+    """Returns the text of the first match query nested in query"""
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key == 'match':
+                value = list(value.values())[0]
+                return value['query'] if isinstance(value, dict) else value
+            found = _match_text(value)
+            if found:
+                return found
+    elif isinstance(query, list):
+        for value in query:
+            found = _match_text(value)
+            if found:
+                return found
+    return ''
+
+
+def _start(handler):
+    server = _ThreadingServer(('127.0.0.1', 0), handler)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
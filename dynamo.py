@@ -0,0 +1,91 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of segments of a parallel scan, see parallel_scan()
+SCAN_SEGMENTS = 4
+
+
+def pages(operation, **kwargs):
+    """Calls a paginated DynamoDB operation (table.scan, table.query...) and
+    yields every response, following LastEvaluatedKey until the last page.
+    Stop iterating to stop reading."""
+    while True:
+        response = operation(**kwargs)
+        yield response
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def items(operation, **kwargs):
+    """Yields the items of every page of a paginated DynamoDB operation"""
+    for response in pages(operation, **kwargs):
+        for item in response.get('Items', ()):
+            yield item
+
+
+def first(operation, **kwargs):
+    """Returns the first item of a paginated DynamoDB operation, reading
+    pages until one holds an item, or None if there are none. Filtered
+    scans and queries may return empty pages before the first match."""
+    for item in items(operation, **kwargs):
+        return item
+    return None
+
+
+def projection(*names):
+    """Returns the ProjectionExpression and ExpressionAttributeNames
+    arguments reading only the attributes names. Placeholders are used so
+    reserved words can be projected, and merge with the names of a
+    FilterExpression built with boto3.dynamodb.conditions."""
+    placeholders = {'#proj{}'.format(i): name for i, name in enumerate(names)}
+    return {
+        'ProjectionExpression': ', '.join(sorted(placeholders)),
+        'ExpressionAttributeNames': placeholders
+    }
+
+
+def parallel_scan(table, segments=SCAN_SEGMENTS, **kwargs):
+    """Scans the table in segments, each read page by page on its own
+    thread, and yields the items as the pages come in. At most two pages per
+    segment wait to be consumed, so memory stays bounded. Only meant for the
+    admin and backfill paths that need a full scan."""
+    if segments < 2:
+        for item in items(table.scan, **kwargs):
+            yield item
+        return
+    results = queue.Queue(maxsize=2 * segments)
+    stopped = []
+
+    def scan_segment(segment):
+        try:
+            for response in pages(table.scan, Segment=segment,
+                                  TotalSegments=segments, **kwargs):
+                if stopped:
+                    return
+                results.put(('page', response['Items']))
+        except Exception as error:
+            results.put(('error', error))
+        finally:
+            results.put(('done', None))
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        for segment in range(segments):
+            pool.submit(scan_segment, segment)
+        running = segments
+        try:
+            while running:
+                kind, value = results.get()
+                if kind == 'done':
+                    running -= 1
+                elif kind == 'error':
+                    raise value
+                else:
+                    for item in value:
+                        yield item
+        finally:
+            # Unblocks the segments if the caller stopped early
+            stopped.append(True)
+            while running:
+                if results.get()[0] == 'done':
+                    running -= 1
@@ -1,18 +1,29 @@
+import bisect
 import boto3
+import hashlib
 import json
 import os
+import re
 import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Attr
 
 HERE = os.path.dirname(os.path.realpath(__file__))
 SITE_PKGS = os.path.join(HERE, 'site-packages')
 sys.path.append(SITE_PKGS)
 
-import feedparser
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
+import dynamo
+import rss
+from metrics import metrics, log
+from snapshot import Snapshot
+from throttle import CLIENT_CONFIG, backoff_delay, limiter
+from titles import TitleIndex
 # from aws_xray_sdk.core import xray_recorder
 # from aws_xray_sdk.core import patch_all
 
@@ -21,129 +32,1414 @@ FEED_URL = os.environ['feedurl']
 DDB_TABLE = os.environ['ddb']
 MIN_SCORE = int(os.environ['minscore'])
 ES_HOST = os.environ['esdomain']
+# Set feedparse to feedparser to parse the whole feed with feedparser
+# instead of streaming its items with rss.parse()
+FEED_PARSER = os.environ.get('feedparse', 'stream')
+# Set indexing to stream to only persist new episodes, stream.main then
+# analyzes and indexes them from the DynamoDB stream of the table
+INDEXING = os.environ.get('indexing', 'inline')
 
-# boto3 clients
-ddb = boto3.client('dynamodb')
-ddb_resource = boto3.resource('dynamodb')
-table = ddb_resource.Table(DDB_TABLE)
-comprehend = boto3.client('comprehend')
-
-# Credentials to be used when adding to Elasticsearch index
-credentials = boto3.Session().get_credentials()
-awsauth = AWS4Auth(credentials.access_key, 
-                    credentials.secret_key, 
-                    boto3.session.Session().region_name,
-                    'es', session_token=credentials.token)
-es = Elasticsearch(
-    hosts = [{'host': ES_HOST, 'port': 443}],
-    http_auth = awsauth,
-    use_ssl = True,
-    verify_certs = True,
-    connection_class = RequestsHttpConnection
-)
-
-def analyze(entry):
-    """Takes the entry from the RSS feed and passes the content (description)
-    of the podcast episode into Amazon Comprehend for entity analysis. If 
-    an entity is returned with a confidence greater than MIN_SCORE, the
-    entity, along with the episode title and published date is added to the
-    Elasticsearch cluster."""
-    entities = comprehend.detect_entities(
-        Text=entry['content'][0]['value'],
-        LanguageCode='en'
-    )
+# Key of the item in the DynamoDB table holding the state of the poller. It
+# has no pub_date so it never shows up in the latest episodes index.
+FEED_STATE_KEY = '__feed_state__'
+
+# Key of the item holding the sorted hashes of every title in the table,
+# used to reject known episodes without reading the table. Hashes are never
+# removed, so an episode deleted from the table is still taken as known
+# until the index is rebuilt with the rebuild_title_index event. Set the
+# dedupindex environment variable to false to disable it.
+TITLE_INDEX_KEY = '__title_index__'
+TITLE_HASH_BYTES = 8
+DEDUP_INDEX = os.environ.get('dedupindex', 'true').lower() == 'true'
+
+# Key of the item holding the latest episodes, newest first, so the skill
+# can answer with a single GetItem instead of scanning the latest index
+LATEST_KEY = '__latest_episodes__'
+LATEST_COUNT = 10
+LATEST_INDEX = os.environ.get('latest_index', 'LatestEpisodes')
+
+# Key of the item holding the trigram index of every title, loaded by the
+# skill to match spoken titles without scanning the table
+TITLE_SEARCH_KEY = '__title_search__'
+
+# Optional S3 bucket the snapshot of the catalog is published to after each
+# ingest, so the skill can answer without reading the table or the cluster
+SNAPSHOT_BUCKET = os.environ.get('snapshotbucket')
+SNAPSHOT_KEY = 'snapshot.json.gz'
+
+# Key of the item updated whenever new episodes are ingested, the skill drops
+# its cached responses when it changes
+GENERATION_KEY = '__ingest_generation__'
+
+# DynamoDB batch settings
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_RETRIES = 5
+
+# Key of the item recording the stage reached by every episode that isn't
+# indexed yet, so a run cut short is picked up by the next one
+CHECKPOINT_KEY = '__ingest_checkpoint__'
+# Time, in milliseconds, left to the invocation under which no new group of
+# entries is started
+STOP_MARGIN_MS = int(os.environ.get('stopmargin', 20000))
+# Number of times a backfill invokes itself again to continue
+BACKFILL_MAX_INVOCATIONS = 50
+# Number of the oldest new entries of the feed a backfill invocation
+# keeps, the next invocation carries on from the last one processed
+BACKFILL_WINDOW = 250
+
+# Maximum number of concurrent requests for each stage of the ingest
+# pipeline. Can be overridden per run with the 'concurrency' key of the event,
+# for example {"concurrency": {"analyze": 4}}.
+STAGE_CONCURRENCY = {
+    'dedup': 4,
+    'persist': 1,
+    'analyze': 2,
+    'index': 2
+}
+# Number of entries flowing through the pipeline together
+INGEST_GROUP_SIZE = 25
+
+# Comprehend batch settings
+COMPREHEND_BATCH_SIZE = 25
+# Segments read at once by the full table scans of the maintenance events
+SCAN_SEGMENTS = int(os.environ.get('scansegments', dynamo.SCAN_SEGMENTS))
+
+# Per document UTF-8 byte limit for BatchDetectEntities
+COMPREHEND_MAX_BYTES = 5000
+
+# Optional DynamoDB table caching the Comprehend entities of every
+# description, keyed on 'digest', a hash of the text and COMPREHEND_PARAMS
+ANALYSIS_CACHE = os.environ.get('analysiscache')
+COMPREHEND_PARAMS = {
+    'Operation': 'BatchDetectEntities',
+    'LanguageCode': 'en',
+    'MaxBytes': COMPREHEND_MAX_BYTES
+}
+
+# Elasticsearch index settings. ES_INDEX is an alias of the current versioned
+# index once reindex() has run.
+ES_INDEX = 'hbrfeedcast'
+ES_TEMPLATE = {
+    'index_patterns': [ES_INDEX + '*'],
+    'settings': {
+        'number_of_shards': 1
+    },
+    'mappings': {
+        '_doc': {
+            'dynamic': False,
+            'properties': {
+                'Text': {
+                    'type': 'text',
+                    'fields': {'keyword': {'type': 'keyword'}}
+                },
+                'Type': {'type': 'keyword'},
+                'Score': {'type': 'float'},
+                'BeginOffset': {'type': 'integer'},
+                'EndOffset': {'type': 'integer'},
+                'title': {
+                    'type': 'text',
+                    'fields': {'keyword': {'type': 'keyword'}}
+                },
+                'published': {
+                    'type': 'date',
+                    # Thu, 31 Aug 2006 13:10:00 -0500
+                    'format': 'EEE, dd MMM yyyy HH:mm:ss Z',
+                    'ignore_malformed': True
+                }
+            }
+        }
+    }
+}
+# Layout of the documents written to Elasticsearch, set with the eslayout
+# environment variable: 'entity' writes one document per entity into
+# ES_INDEX, 'episode' writes one document per episode, holding its entities,
+# into ES_EPISODE_INDEX
+ES_LAYOUT = os.environ.get('eslayout', 'entity')
+ES_EPISODE_INDEX = 'hbrepisodes'
+ES_EPISODE_TEMPLATE = {
+    'index_patterns': [ES_EPISODE_INDEX + '*'],
+    'settings': {
+        'number_of_shards': 1
+    },
+    'mappings': {
+        '_doc': {
+            'dynamic': False,
+            'properties': {
+                'title': {
+                    'type': 'text',
+                    'fields': {'keyword': {'type': 'keyword'}}
+                },
+                'episode': {'type': 'keyword'},
+                'description': {'type': 'text'},
+                'published': {
+                    'type': 'date',
+                    'format': 'EEE, dd MMM yyyy HH:mm:ss Z',
+                    'ignore_malformed': True
+                },
+                'entities': {
+                    'type': 'nested',
+                    'properties': {
+                        'Text': {
+                            'type': 'text',
+                            'fields': {'keyword': {'type': 'keyword'}}
+                        },
+                        'Type': {'type': 'keyword'},
+                        'Score': {'type': 'float'}
+                    }
+                }
+            }
+        }
+    }
+}
+# Upper bounds for a single _bulk request body
+BULK_MAX_BYTES = 5 * 1024 * 1024
+BULK_MAX_DOCS = 500
+# Number of times failed bulk items are resubmitted
+BULK_RETRIES = 3
+# Bulk item statuses worth retrying (throttled or server side errors)
+BULK_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Lazy(object):
+    """Stands in for a client that is only built, by calling factory, the
+    first time one of its attributes is used. Runs that stop early, like a
+    304 from the feed, never pay for the clients they don't need."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instance = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    self.instance = self.factory()
+        return getattr(self.instance, name)
+
+
+def __build_es():
+    """Returns the Elasticsearch client, signed with the credentials of the
+    function"""
+    from elasticsearch import Elasticsearch, RequestsHttpConnection
+    from requests_aws4auth import AWS4Auth
+    credentials = boto3.Session().get_credentials()
+    awsauth = AWS4Auth(credentials.access_key, 
+                        credentials.secret_key, 
+                        boto3.session.Session().region_name,
+                        'es', session_token=credentials.token)
+    return limiter.instrument_es(metrics.instrument_es(Elasticsearch(
+        hosts = [{'host': ES_HOST, 'port': 443}],
+        http_auth = awsauth,
+        use_ssl = True,
+        verify_certs = True,
+        connection_class = RequestsHttpConnection
+    )))
+
+def __build_client(service):
+    """Returns the boto3 client of service"""
+    return limiter.instrument(metrics.instrument(
+        boto3.client(service, config=CLIENT_CONFIG)))
+
+def __build_table():
+    """Returns the DynamoDB table resource"""
+    table = boto3.resource('dynamodb', config=CLIENT_CONFIG).Table(DDB_TABLE)
+    limiter.instrument(metrics.instrument(table.meta.client))
+    return table
+
+# boto3 clients, every call they make is recorded by metrics, paced by the
+# limiter and retried within the retry budget of the invocation
+ddb = Lazy(lambda: __build_client('dynamodb'))
+table = Lazy(__build_table)
+comprehend = Lazy(lambda: __build_client('comprehend'))
+lambda_client = Lazy(lambda: __build_client('lambda'))
+s3 = Lazy(lambda: __build_client('s3'))
+
+# Elasticsearch client, signed with the credentials of the function
+es = Lazy(__build_es)
+
+def analyze_entries(entries):
+    """Analyzes the content of several entries with Comprehend's
+    BatchDetectEntities API, sending up to COMPREHEND_BATCH_SIZE documents per
+    call. Descriptions longer than COMPREHEND_MAX_BYTES are split into chunks
+    and the entities of every chunk are merged back into their entry. Returns
+    the Elasticsearch documents of the entries, in the layout set by
+    ES_LAYOUT, along with the set of titles of the entries Comprehend
+    failed to analyze, which have no documents.
+
+    When ANALYSIS_CACHE is set, the entities of descriptions analyzed before
+    are read from the cache and only the others are sent to Comprehend.
+    Their entities are then added to the cache."""
+    keys = [analysis_key(entry['content'][0]['value']) for entry in entries]
+    cached = cached_analyses(keys)
+    # (entry position, offset, text) for every chunk that needs to be
+    # analyzed
+    chunks = []
+    for position, entry in enumerate(entries):
+        if keys[position] in cached:
+            continue
+        for offset, text in __chunk_text(entry['content'][0]['value']):
+            chunks.append((position, offset, text))
+    entities = [cached.get(key, []) for key in keys]
+    errors = set()
+    for start in range(0, len(chunks), COMPREHEND_BATCH_SIZE):
+        batch = chunks[start:start + COMPREHEND_BATCH_SIZE]
+        response = comprehend.batch_detect_entities(
+            TextList=[text for _, _, text in batch],
+            LanguageCode=COMPREHEND_PARAMS['LanguageCode']
+        )
+        for result in response['ResultList']:
+            position, offset, _ = batch[result['Index']]
+            # Offsets are relative to the chunk, move them back to the entry
+            entities[position].extend(
+                dict(entity, BeginOffset=entity['BeginOffset'] + offset,
+                     EndOffset=entity['EndOffset'] + offset)
+                for entity in result['Entities'])
+        for error in response['ErrorList']:
+            position = batch[error['Index']][0]
+            errors.add(position)
+            print('Problem analyzing {}: {} {}'.format(
+                entries[position]['title'], error['ErrorCode'],
+                error['ErrorMessage']))
+    analyzed = set(chunk[0] for chunk in chunks) - errors
+    save_analyses({keys[position]: entities[position]
+                   for position in analyzed})
+    documents = entity_documents(
+        [entry for position, entry in enumerate(entries)
+         if position not in errors],
+        [entry_entities for position, entry_entities in enumerate(entities)
+         if position not in errors])
+    return documents, set(entries[position]['title'] for position in errors)
+
+def entity_documents(entries, entities):
+    """Returns the Elasticsearch documents of the entries, in the layout set
+    by ES_LAYOUT, from the Comprehend entities of each entry"""
+    documents = []
+    for entry, entry_entities in zip(entries, entities):
+        filtered = __entity_documents(entry, entry_entities)
+        if ES_LAYOUT == 'episode':
+            documents.append(episode_document(entry, filtered))
+        else:
+            documents.extend(filtered)
+    return documents
+
+def analysis_key(text):
+    """Returns the key of the analysis of text in the analysis cache"""
+    params = json.dumps(COMPREHEND_PARAMS, sort_keys=True)
+    return hashlib.sha256(
+        '{}\n{}'.format(params, text).encode('utf-8')).hexdigest()
+
+def cached_analyses(keys):
+    """Returns the entities cached for the keys, as a dict of key to the
+    list of entities"""
+    if not ANALYSIS_CACHE or not keys:
+        return {}
+    cached = {}
+    unique = sorted(set(keys))
+    for start in range(0, len(unique), BATCH_GET_SIZE):
+        items = __batch_get(
+            [{'digest': {'S': key}}
+             for key in unique[start:start + BATCH_GET_SIZE]],
+            ANALYSIS_CACHE, None)
+        for item in items:
+            cached[item['digest']['S']] = json.loads(
+                zlib.decompress(item['entities']['B']).decode('utf-8'))
+    return cached
+
+def save_analyses(analyses):
+    """Adds the entities of each key to the analysis cache, compressed"""
+    if not ANALYSIS_CACHE or not analyses:
+        return
+    writes = WriteBuffer(ANALYSIS_CACHE)
+    for key, entities in analyses.items():
+        writes.put({
+            'digest': {'S': key},
+            'entities': {'B': zlib.compress(
+                json.dumps(entities).encode('utf-8'))}
+        })
+    writes.flush()
+
+def rebuild_index():
+    """Indexes every episode of the DynamoDB table again from the analysis
+    cache, without calling Comprehend. Episodes with no cached analysis are
+    skipped. Returns the number of episodes indexed."""
+    indexed = 0
+    missing = 0
+    ensure_index()
+    episodes = dynamo.parallel_scan(
+        table, SCAN_SEGMENTS,
+        FilterExpression=Attr('pub_date').exists(),
+        **dynamo.projection('title', 'published', 'link', 'author',
+                            'content'))
+    batch = []
+    for item in episodes:
+        batch.append(entry_from_item(item))
+        if len(batch) == BATCH_GET_SIZE:
+            found = __index_from_cache(batch)
+            indexed += found
+            missing += len(batch) - found
+            batch = []
+    if batch:
+        found = __index_from_cache(batch)
+        indexed += found
+        missing += len(batch) - found
+    print('Rebuilt the index of {} episodes, {} had no cached analysis'.format(
+        indexed, missing))
+    return indexed
+
+def __index_from_cache(entries):
+    """Indexes the entries that have a cached analysis. Returns how many
+    did."""
+    keys = [analysis_key(entry['content'][0]['value']) for entry in entries]
+    cached = cached_analyses(keys)
+    found = [(entry, cached[key]) for entry, key in zip(entries, keys)
+             if key in cached]
+    documents = entity_documents([entry for entry, _ in found],
+                                 [entities for _, entities in found])
+    if documents:
+        bulk_index(documents)
+    return len(found)
+
+def episode_document(entry, entities):
+    """Returns the Elasticsearch document of an episode holding its
+    entities, for the 'episode' layout"""
+    return {
+        'title': entry['title'],
+        'episode': entry['title'].split(':')[0],
+        'description': entry['content'][0]['value'],
+        'published': entry['published'],
+        'entities': [{
+            'Text': entity['Text'],
+            'Type': entity['Type'],
+            'Score': entity['Score']
+        } for entity in entities]
+    }
+
+def __entity_documents(entry, entities):
+    """Filters the Comprehend entities of an entry by MIN_SCORE, removes
+    duplicates and returns them as Elasticsearch documents"""
     index_entries = {}
-    for entity in entities['Entities']:
+    for entity in entities:
         if (entity['Score'] * 100) < MIN_SCORE:
-            print('Entity has a confidence score below threshold')
+            log('Entity has a confidence score below threshold')
         elif entity['Text'] in index_entries:
-            print('Entity already in index')
+            log('Entity already in index')
         else:
-            entity['title'] = entry['title']
-            entity['published'] = entry['published']
-            print('Adding {} into elasticsearch domain'.format(entity))
-            # PUT into ES domain
-            es.index(
-                index='hbrfeedcast',
-                doc_type='_doc',
-                body=entity
-            )
-
-def add_to_ddb(entry):
-    """Adds this entry into the DynamoDB table"""
-    # Thu, 31 Aug 2006 13:10:00 -0500
-    d = datetime.strptime(entry['published'], '%a, %d %b %Y %H:%M:%S %z')
+            # Copied, as cached entities may be shared by several entries
+            entity = dict(entity, title=entry['title'],
+                          published=entry['published'])
+            log('Queueing {} for elasticsearch domain'.format(entity))
+            index_entries[entity['Text']] = entity
+    return list(index_entries.values())
+
+def __chunk_text(text):
+    """Splits text on whitespace into chunks no larger than
+    COMPREHEND_MAX_BYTES when UTF-8 encoded. Returns (offset, chunk) pairs,
+    where offset is the position of the chunk in text, so the offsets of the
+    entities found in a chunk can be moved back to text. Empty text returns
+    no chunks."""
+    if len(text.encode('utf-8')) <= COMPREHEND_MAX_BYTES:
+        return [(0, text)] if text.strip() else []
+    chunks = []
+    start = end = None
+    current_bytes = 0
+    for word in re.finditer(r'\S+', text):
+        size = len(word.group().encode('utf-8'))
+        if size > COMPREHEND_MAX_BYTES:
+            # A single word over the limit is cut at the byte boundary
+            if start is not None:
+                chunks.append((start, text[start:end]))
+                start = None
+            chunks.append((word.start(), word.group().encode('utf-8')[
+                :COMPREHEND_MAX_BYTES].decode('utf-8', 'ignore')))
+            continue
+        if start is not None:
+            # The whitespace between the words is kept, so offsets line up
+            size += len(text[end:word.start()].encode('utf-8'))
+            if current_bytes + size > COMPREHEND_MAX_BYTES:
+                chunks.append((start, text[start:end]))
+                start = None
+                size = len(word.group().encode('utf-8'))
+        if start is None:
+            start = word.start()
+            current_bytes = 0
+        current_bytes += size
+        end = word.end()
+    if start is not None:
+        chunks.append((start, text[start:end]))
+    return chunks
+
+def put_index_template():
+    """Saves ES_TEMPLATE and ES_EPISODE_TEMPLATE so every index created for
+    ES_INDEX or ES_EPISODE_INDEX uses the explicit mapping"""
+    es.indices.put_template(name=ES_INDEX, body=ES_TEMPLATE)
+    es.indices.put_template(name=ES_EPISODE_INDEX, body=ES_EPISODE_TEMPLATE)
+
+def ensure_episode_index():
+    """Saves the index templates if the episode index doesn't exist yet, so
+    it is created with the nested entities mapping"""
+    if not es.indices.exists(index=ES_EPISODE_INDEX):
+        put_index_template()
+
+def ensure_entity_index():
+    """Saves the index templates if the entity index, or its alias, doesn't
+    exist yet, so it is created with the explicit mapping instead of a
+    dynamic one where Type is text and published isn't a date"""
+    if not es.indices.exists(index=ES_INDEX):
+        put_index_template()
+
+def ensure_index():
+    """Saves the index templates if the index of ES_LAYOUT doesn't exist
+    yet"""
+    if ES_LAYOUT == 'episode':
+        ensure_episode_index()
+    else:
+        ensure_entity_index()
+
+def reindex():
+    """Copies the documents of ES_INDEX into a new versioned index using the
+    current template, then points the ES_INDEX alias at it. A concrete index
+    named ES_INDEX, created with dynamic mapping, is deleted once copied.
+    Returns the name of the new index."""
+    put_index_template()
+    new_index = '{}-{}'.format(ES_INDEX,
+                               datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+    es.indices.create(index=new_index)
+    if es.indices.exists(index=ES_INDEX):
+        es.reindex(
+            body={'source': {'index': ES_INDEX}, 'dest': {'index': new_index}},
+            wait_for_completion=True,
+            refresh=True
+        )
+    actions = [{'add': {'index': new_index, 'alias': ES_INDEX}}]
+    if es.indices.exists_alias(name=ES_INDEX):
+        for old_index in es.indices.get_alias(name=ES_INDEX):
+            actions.append({'remove': {'index': old_index, 'alias': ES_INDEX}})
+    elif es.indices.exists(index=ES_INDEX):
+        es.indices.delete(index=ES_INDEX)
+    es.indices.update_aliases(body={'actions': actions})
+    print('Reindexed {} into {}'.format(ES_INDEX, new_index))
+    return new_index
+
+def bulk_index(documents):
+    """Sends the documents to the Elasticsearch cluster using the _bulk API.
+    Documents are split into requests bounded by BULK_MAX_BYTES and
+    BULK_MAX_DOCS. Items that fail with a retryable status are resubmitted
+    up to BULK_RETRIES times, within the retry budget of the limiter, and
+    all other failures are reported. Returns a tuple of the number of
+    documents indexed and the list of documents that failed.
+
+    Documents go to the index of ES_LAYOUT. Episode documents use their
+    title as id and entity documents a hash of title and entity text, so
+    indexing a document again replaces it."""
+    pending = list(documents)
+    indexed = 0
+    failed = []
+    for attempt in range(BULK_RETRIES + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            if not limiter.spend():
+                break
+            print('Retrying {} failed bulk items (attempt {})'.format(
+                len(pending), attempt))
+            time.sleep(0.5 * 2 ** attempt)
+        retry = []
+        for batch in __bulk_batches(pending):
+            body = ''.join(line for line, _ in batch)
+            response = es.bulk(body=body)
+            if not response['errors']:
+                indexed += len(batch)
+                continue
+            throttled = False
+            for item, (_, document) in zip(response['items'], batch):
+                result = item['index']
+                if 'error' not in result:
+                    indexed += 1
+                elif result['status'] in BULK_RETRY_STATUSES:
+                    retry.append(document)
+                    throttled = throttled or result['status'] == 429
+                else:
+                    print('Problem indexing {}: {}'.format(
+                        document, result['error']))
+                    failed.append(document)
+            if throttled:
+                limiter.throttled('es')
+        pending = retry
+    for document in pending:
+        print('Giving up indexing {}'.format(document))
+    failed.extend(pending)
+    print('Bulk indexed {} documents, {} failed'.format(indexed, len(failed)))
+    return indexed, failed
+
+def __bulk_batches(documents):
+    """Yields lists of (ndjson lines, document) pairs, each list small
+    enough to be sent as a single _bulk request"""
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        if ES_LAYOUT == 'episode':
+            action = {'_index': ES_EPISODE_INDEX, '_type': '_doc',
+                      '_id': document['title']}
+        else:
+            # The id is derived from the entity so indexing again is a no-op
+            entity_id = hashlib.sha1('{}|{}'.format(
+                document['title'], document['Text']).encode('utf-8'))
+            action = {'_index': ES_INDEX, '_type': '_doc',
+                      '_id': entity_id.hexdigest()}
+        line = '{}\n{}\n'.format(json.dumps({'index': action}),
+                                  json.dumps(document))
+        size = len(line.encode('utf-8'))
+        if batch and (batch_bytes + size > BULK_MAX_BYTES or
+                      len(batch) == BULK_MAX_DOCS):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((line, document))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def ddb_item(entry):
+    """Returns the DynamoDB item for this entry"""
+    d = parse_published(entry['published'])
     pub_date = d.strftime('%Y-%m-%d')
     pub_time = d.strftime('%H:%M:%S')
     try:
         episode = entry['title'].split(':')[0]
     except IndexError:
         episode = '0000'
+    return {
+        'title': {
+            'S': entry['title']
+        },
+        'pub_date': {
+            'S': pub_date
+        },
+        'pub_time': {
+            'S': pub_time
+        },
+        'episode': {
+            'S': episode
+        },
+        'published': {
+            'S': entry['published']
+        },
+        'link': {
+            'S': entry['link']
+        },
+        'author': {
+            'S': entry['author']
+        },
+        'content': {
+            'S': entry['content'][0]['value']
+        }
+    }
+
+
+class WriteBuffer(object):
+    """Queues items for a DynamoDB table and writes them with BatchWriteItem
+    in groups of BATCH_WRITE_SIZE. Unprocessed items, a sign the table is
+    throttled, are retried with a jittered exponential backoff within the
+    retry budget of the limiter, and items that still can't be written are
+    kept in failed so the caller can deal with them."""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.queue = []
+        self.written = 0
+        self.retried = 0
+        self.failed = []
+
+    def put(self, item):
+        """Queues an item, flushing the queue once a batch is full"""
+        self.queue.append(item)
+        if len(self.queue) == BATCH_WRITE_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes every queued item"""
+        while self.queue:
+            batch = self.queue[:BATCH_WRITE_SIZE]
+            self.queue = self.queue[BATCH_WRITE_SIZE:]
+            self.__write(batch)
+
+    def tally(self):
+        """Returns the number of items written, retried and failed"""
+        return {
+            'written': self.written,
+            'retried': self.retried,
+            'failed': len(self.failed)
+        }
+
+    def __write(self, items):
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        for attempt in range(BATCH_RETRIES + 1):
+            if attempt > 0:
+                if not limiter.spend():
+                    break
+                self.retried += len(requests)
+                time.sleep(backoff_delay(attempt))
+            try:
+                response = ddb.batch_write_item(
+                    RequestItems={self.table_name: requests}
+                )
+            except ClientError as error:
+                print('Problem writing to DynamoDB: {}'.format(error))
+                continue
+            unprocessed = response.get('UnprocessedItems', {})
+            remaining = unprocessed.get(self.table_name, [])
+            self.written += len(requests) - len(remaining)
+            requests = remaining
+            if not requests:
+                return
+            limiter.throttled('dynamodb.{}.write'.format(self.table_name))
+        for request in requests:
+            item = request['PutRequest']['Item']
+            print('Giving up writing {} to DynamoDB'.format(item['title']['S']))
+            self.failed.append(item)
+
+def parse_published(published):
+    """Returns the datetime of a published date from the feed"""
+    # Thu, 31 Aug 2006 13:10:00 -0500
+    return datetime.strptime(published, '%a, %d %b %Y %H:%M:%S %z')
+
+def entry_guid(entry):
+    """Returns the GUID of the entry, falling back to its link"""
+    return entry.get('id') or entry['link']
+
+def get_feed_state():
+    """Returns the state saved by the previous run of the poller: the ETag
+    and Last-Modified headers of the feed along with the GUID and published
+    date of the newest entry processed. Returns an empty dict if there is
+    no state yet."""
     try:
-        response = ddb.put_item(
-            TableName=DDB_TABLE,
-            Item={
-                'title': {
-                    'S': entry['title']
-                },
-                'pub_date': {
-                    'S': pub_date
-                },
-                'pub_time': {
-                    'S': pub_time
-                },
-                'episode': {
-                    'S': episode
-                },
-                'published': {
-                    'S': entry['published']
-                },
-                'link': {
-                    'S': entry['link']
-                },
-                'author': {
-                    'S': entry['author']
-                },
-                'content': {
-                    'S': entry['content'][0]['value']
-                }
-            }
+        response = table.get_item(
+            Key={'title': FEED_STATE_KEY},
+            ConsistentRead=True
         )
     except ClientError as error:
-        print('Problem updating DynamoDB: {}'.format(error))
-        # TO DO: Raise error here?
-    
-
-def already_added(title):
-    """Checks if the entry is already in DyanomDB. Returns True if found,
-    otherwise returns False."""
-    response = table.query(
-        KeyConditionExpression=Key('title').eq(title)
+        print('Problem getting feed state: {}'.format(error))
+        return {}
+    return response.get('Item', {})
+
+def save_feed_state(state):
+    """Saves the state of the poller into the DynamoDB table"""
+    item = {k: v for k, v in state.items() if v}
+    item['title'] = FEED_STATE_KEY
+    try:
+        table.put_item(Item=item)
+    except ClientError as error:
+        print('Problem saving feed state: {}'.format(error))
+
+def fetch_feed(state):
+    """Requests the feed conditionally with the ETag and Last-Modified
+    headers saved in state. The entries are parsed one at a time as the
+    response is read unless FEED_PARSER is feedparser."""
+    if FEED_PARSER == 'feedparser':
+        import feedparser
+        return feedparser.parse(
+            FEED_URL,
+            etag=state.get('etag'),
+            modified=state.get('modified')
+        )
+    return rss.parse(
+        FEED_URL,
+        etag=state.get('etag'),
+        modified=state.get('modified')
     )
-    if response['Count'] == 0:
+
+def new_entries(entries, state, limit, lookup):
+    """Walks the feed entries from the newest and stops at the first one
+    already processed by a previous run, according to state, which closes
+    streamed entries early. The titles of the unseen entries are passed to
+    lookup, BATCH_GET_SIZE at a time as they are read, which returns those
+    already saved. Only the oldest limit entries that aren't saved are kept
+    whole, the others are reduced to their guid, title and published date so
+    memory doesn't grow with the feed. Returns the unseen entries, oldest
+    first, along with the set of titles already saved."""
+    last_guid = state.get('last_guid')
+    last_published = state.get('last_published')
+    if last_published:
+        last_published = parse_published(last_published)
+    unseen = []
+    known = set()
+    # (position in unseen, entry) of the oldest entries not saved
+    kept = deque(maxlen=limit)
+    batch = []
+
+    def look_up():
+        known.update(lookup([entry['title'] for _, entry in batch]))
+        kept.extend((position, entry) for position, entry in batch
+                    if entry['title'] not in known)
+        del batch[:]
+
+    for entry in entries:
+        if entry_guid(entry) == last_guid:
+            break
+        if last_published and parse_published(entry['published']) <= last_published:
+            break
+        batch.append((len(unseen), entry))
+        unseen.append({'id': entry_guid(entry), 'title': entry['title'],
+                       'published': entry['published']})
+        if len(batch) == BATCH_GET_SIZE:
+            look_up()
+    if hasattr(entries, 'close'):
+        entries.close()
+    look_up()
+    for position, entry in kept:
+        unseen[position] = entry
+    unseen.reverse()
+    return unseen, known
+
+def title_hash(title):
+    """Returns the hash of a title as stored in the title index"""
+    return hashlib.sha1(title.encode('utf-8')).digest()[:TITLE_HASH_BYTES]
+
+def load_title_index():
+    """Returns the sorted list of title hashes saved in the DynamoDB table,
+    or an empty list if there is no index yet"""
+    try:
+        response = table.get_item(Key={'title': TITLE_INDEX_KEY})
+    except ClientError as error:
+        print('Problem getting title index: {}'.format(error))
+        return []
+    if 'Item' not in response:
+        return []
+    hashes = response['Item']['hashes'].value
+    return [hashes[i:i + TITLE_HASH_BYTES]
+            for i in range(0, len(hashes), TITLE_HASH_BYTES)]
+
+def save_title_index(index):
+    """Saves the sorted list of title hashes into the DynamoDB table"""
+    try:
+        table.put_item(Item={
+            'title': TITLE_INDEX_KEY,
+            'hashes': b''.join(index)
+        })
+    except ClientError as error:
+        print('Problem saving title index: {}'.format(error))
+
+def rebuild_title_index():
+    """Builds the title index again from the titles of every episode of the
+    table, dropping the hashes of deleted episodes. Returns the number of
+    titles in the index."""
+    episodes = dynamo.parallel_scan(
+        table, SCAN_SEGMENTS,
+        FilterExpression=Attr('pub_date').exists(),
+        **dynamo.projection('title'))
+    index = sorted(set(title_hash(item['title']) for item in episodes))
+    save_title_index(index)
+    print('Rebuilt the title index of {} episodes'.format(len(index)))
+    return len(index)
+
+def add_to_title_index(index, title):
+    """Adds the hash of title into the sorted index. Returns True if the
+    index changed."""
+    h = title_hash(title)
+    position = bisect.bisect_left(index, h)
+    if position < len(index) and index[position] == h:
         return False
+    index.insert(position, h)
+    return True
+
+def in_title_index(index, title):
+    """Returns True if the hash of title is in the sorted index"""
+    h = title_hash(title)
+    position = bisect.bisect_left(index, h)
+    return position < len(index) and index[position] == h
+
+def added_titles(titles, index=None, workers=1):
+    """Returns the set of titles already in DynamoDB. Titles found in the
+    optional title index are known without a request, the others are looked
+    up with BatchGetItem in chunks of BATCH_GET_SIZE, up to workers chunks at
+    a time. Titles found that way are added to the index."""
+    known = set()
+    lookup = []
+    for title in titles:
+        if index is not None and in_title_index(index, title):
+            known.add(title)
+        elif title not in lookup:
+            lookup.append(title)
+    chunks = [[{'title': {'S': title}}
+               for title in lookup[start:start + BATCH_GET_SIZE]]
+              for start in range(0, len(lookup), BATCH_GET_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for items in pool.map(__dedup_batch_get, chunks):
+            for item in items:
+                known.add(item['title']['S'])
+                if index is not None:
+                    add_to_title_index(index, item['title']['S'])
+    return known
+
+def __batch_get(keys, table_name=DDB_TABLE, projection='title'):
+    """Gets the keys from a DynamoDB table with BatchGetItem, retrying
+    unprocessed keys with a jittered exponential backoff within the retry
+    budget of the limiter. Returns the items found, with only the projection
+    attributes if given."""
+    items = []
+    request = {table_name: {'Keys': keys}}
+    if projection:
+        request[table_name]['ProjectionExpression'] = projection
+    for attempt in range(BATCH_RETRIES + 1):
+        if attempt > 0:
+            if not limiter.spend():
+                break
+            time.sleep(backoff_delay(attempt))
+        response = ddb.batch_get_item(RequestItems=request)
+        items.extend(response['Responses'].get(table_name, []))
+        request = response.get('UnprocessedKeys')
+        if not request:
+            return items
+        limiter.throttled('dynamodb.{}.read'.format(table_name))
+    raise RuntimeError('Unable to read {} keys from DynamoDB'.format(
+        len(request[table_name]['Keys'])))
+
+def __dedup_batch_get(keys):
+    """Runs __batch_get on the dedup thread pool, tagging its calls with the
+    dedup stage"""
+    with metrics.stage('dedup'):
+        return __batch_get(keys)
+
+def load_checkpoint():
+    """Returns the episodes that aren't indexed yet, as a dict of title to
+    'pending'. Pending episodes may not have been saved."""
+    try:
+        response = table.get_item(
+            Key={'title': CHECKPOINT_KEY},
+            ConsistentRead=True
+        )
+        if 'Item' not in response:
+            table.put_item(Item={'title': CHECKPOINT_KEY, 'stages': {}})
+            return {}
+    except ClientError as error:
+        print('Problem getting ingest checkpoint: {}'.format(error))
+        return {}
+    return response['Item']['stages']
+
+def checkpoint(titles, stage):
+    """Records that the episodes reached stage. Indexed episodes are
+    removed from the checkpoint."""
+    if not titles:
+        return
+    names = {'#t{}'.format(i): title for i, title in enumerate(titles)}
+    kwargs = {'ExpressionAttributeNames': names}
+    if stage == 'indexed':
+        kwargs['UpdateExpression'] = 'REMOVE ' + ', '.join(
+            'stages.{}'.format(name) for name in names)
+    else:
+        kwargs['UpdateExpression'] = 'SET ' + ', '.join(
+            'stages.{} = :stage'.format(name) for name in names)
+        kwargs['ExpressionAttributeValues'] = {':stage': stage}
+    try:
+        table.update_item(Key={'title': CHECKPOINT_KEY}, **kwargs)
+    except ClientError as error:
+        print('Problem updating ingest checkpoint: {}'.format(error))
+
+def saved_entry(title):
+    """Returns the episode saved in DynamoDB in the shape of a feed entry,
+    or None if it isn't there"""
+    try:
+        response = table.get_item(Key={'title': title})
+    except ClientError as error:
+        print('Problem getting {}: {}'.format(title, error))
+        return None
+    if 'Item' not in response:
+        return None
+    return entry_from_item(response['Item'])
+
+def entry_from_item(item):
+    """Returns an episode item of the DynamoDB table in the shape of a feed
+    entry"""
+    return {
+        'title': item['title'],
+        'published': item['published'],
+        'link': item['link'],
+        'author': item['author'],
+        'content': [{'value': item['content']}]
+    }
+
+def update_latest(entries):
+    """Merges the entries into the latest episodes item, keeping the newest
+    LATEST_COUNT episodes. The item is built from the latest index the first
+    time."""
+    try:
+        response = table.get_item(
+            Key={'title': LATEST_KEY},
+            ConsistentRead=True
+        )
+    except ClientError as error:
+        print('Problem getting latest episodes: {}'.format(error))
+        return
+    if 'Item' in response:
+        episodes = response['Item']['episodes']
+    else:
+        episodes = __scan_latest_index()
+    for entry in entries:
+        item = ddb_item(entry)
+        episodes.append({
+            'title': entry['title'],
+            'pub_date': item['pub_date']['S'],
+            'pub_time': item['pub_time']['S']
+        })
+    latest = {}
+    for episode in episodes:
+        latest[episode['title']] = episode
+    episodes = sorted(latest.values(),
+                      key=lambda k: (k['pub_date'], k['pub_time']),
+                      reverse=True)
+    try:
+        table.put_item(Item={
+            'title': LATEST_KEY,
+            'episodes': episodes[:LATEST_COUNT]
+        })
+    except ClientError as error:
+        print('Problem saving latest episodes: {}'.format(error))
+
+def update_title_search(entries):
+    """Adds the titles of the entries to the title search index. The index
+    is built from the latest index the first time."""
+    try:
+        response = table.get_item(
+            Key={'title': TITLE_SEARCH_KEY},
+            ConsistentRead=True
+        )
+    except ClientError as error:
+        print('Problem getting title search index: {}'.format(error))
+        return
+    if 'Item' in response:
+        index = TitleIndex.loads(response['Item']['index'].value)
+    else:
+        index = TitleIndex(sorted(
+            episode['title'] for episode in __scan_latest_index()))
+    updated = index.add([entry['title'] for entry in entries])
+    if updated is index and 'Item' in response:
+        return
+    try:
+        table.put_item(Item={
+            'title': TITLE_SEARCH_KEY,
+            'index': updated.dumps()
+        })
+    except ClientError as error:
+        print('Problem saving title search index: {}'.format(error))
+
+def publish_snapshot(version, added=None):
+    """Publishes the snapshot of every episode of the table to
+    SNAPSHOT_BUCKET, as version, the ingest generation it is current for.
+    The entities of the episodes come from the analysis cache, episodes with
+    no cached analysis have none in the snapshot.
+
+    With added, the entries just ingested, the snapshot of the current
+    generation is extended with them, and its episodes with no entities are
+    looked up again as stream.main may have analyzed them since. The table
+    is only scanned when that snapshot is missing or stale."""
+    if not SNAPSHOT_BUCKET:
+        return
+    previous = None
+    if added is not None:
+        previous = load_snapshot()
+        generation = load_generation()
+        if previous is not None and previous.version != generation:
+            print('Snapshot {} is stale, publishing every episode'.format(
+                previous.version))
+            previous = None
+    if previous is None:
+        episodes = list(dynamo.parallel_scan(
+            table, SCAN_SEGMENTS,
+            FilterExpression=Attr('pub_date').exists(),
+            **dynamo.projection('title', 'published', 'pub_date',
+                                'pub_time', 'episode', 'content')))
+    else:
+        episodes = [snapshot_episode(entry) for entry in added]
+        titles = set(entry['title'] for entry in added)
+        # published isn't kept in the snapshot, nor needed to build it
+        episodes.extend(dict(episode, published=None)
+                        for episode in previous.unanalyzed()
+                        if episode['title'] not in titles)
+    keys = [analysis_key(episode['content']) for episode in episodes]
+    cached = {}
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        cached.update(cached_analyses(keys[start:start + BATCH_GET_SIZE]))
+    for episode, key in zip(episodes, keys):
+        episode['entities'] = __entity_documents(
+            episode, cached.get(key, []))
+    if previous is None:
+        snapshot = Snapshot.build(version, episodes)
+    else:
+        snapshot = previous.extend(version, episodes)
+    data = snapshot.dumps()
+    s3.put_object(
+        Bucket=SNAPSHOT_BUCKET,
+        Key=SNAPSHOT_KEY,
+        Body=data,
+        ContentType='application/gzip',
+        Metadata={'version': version}
+    )
+    print('Published snapshot {} of {} episodes, {} bytes'.format(
+        version, len(snapshot), len(data)))
+
+def snapshot_episode(entry):
+    """Returns an entry as an episode of the snapshot, without its
+    entities"""
+    item = ddb_item(entry)
+    return {
+        'title': entry['title'],
+        'episode': item['episode']['S'],
+        'pub_date': item['pub_date']['S'],
+        'pub_time': item['pub_time']['S'],
+        'published': entry['published'],
+        'content': entry['content'][0]['value']
+    }
+
+def load_snapshot():
+    """Returns the snapshot published to SNAPSHOT_BUCKET, or None if there
+    is none yet"""
+    try:
+        response = s3.get_object(Bucket=SNAPSHOT_BUCKET, Key=SNAPSHOT_KEY)
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return None
+    return Snapshot.loads(response['Body'].read())
+
+def publish_generation(entries, has_time=lambda: True):
+    """Starts a new ingest generation for the entries just saved or
+    indexed, once the snapshot is extended with them if has_time()"""
+    generation = new_generation()
+    if has_time():
+        try:
+            publish_snapshot(generation, entries)
+        except Exception as error:
+            # Any error, the skill skips the stale snapshot and the next
+            # run publishes every episode
+            print('Problem publishing snapshot: {}'.format(error))
+    else:
+        print('No time left to publish the snapshot')
+    save_generation(generation)
+
+def new_generation():
+    """Returns the name of a new ingest generation"""
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def load_generation():
+    """Returns the current ingest generation, or None if there is none
+    yet"""
+    try:
+        response = table.get_item(
+            Key={'title': GENERATION_KEY},
+            ConsistentRead=True
+        )
+    except ClientError as error:
+        print('Problem getting ingest generation: {}'.format(error))
+        return None
+    return response.get('Item', {}).get('generation')
+
+def save_generation(generation):
+    """Marks a new ingest generation so the skill drops its cached
+    responses"""
+    try:
+        table.put_item(Item={
+            'title': GENERATION_KEY,
+            'generation': generation
+        })
+    except ClientError as error:
+        print('Problem saving ingest generation: {}'.format(error))
+
+def __scan_latest_index():
+    """Returns every episode in the latest index. Only used to build the
+    latest episodes item and the title search index the first time."""
+    return list(dynamo.items(table.scan, IndexName=LATEST_INDEX))
+
+def backfill_episode_numbers():
+    """Sets the episode attribute on episodes saved without one so they show
+    up in the episode number index. Returns the number of episodes
+    updated."""
+    updated = 0
+    episodes = dynamo.parallel_scan(
+        table, SCAN_SEGMENTS,
+        FilterExpression=Attr('episode').not_exists() &
+                         Attr('pub_date').exists(),
+        **dynamo.projection('title'))
+    for item in episodes:
+        table.update_item(
+            Key={'title': item['title']},
+            UpdateExpression='SET episode = :episode',
+            ExpressionAttributeValues={
+                ':episode': item['title'].split(':')[0]
+            }
+        )
+        updated += 1
+    print('Backfilled the episode number of {} episodes'.format(updated))
+    return updated
+
+def ingest(entries, concurrency, has_time=lambda: True, persist=True):
+    """Persists, analyzes and indexes the entries. Entries flow through the
+    stages in groups of INGEST_GROUP_SIZE so that one group can be analyzed
+    while the next is written, and the number of groups in each stage at once
+    is bounded by concurrency. Returns the entries saved, in the order given,
+    along with the tally of DynamoDB writes and the titles that weren't
+    saved.
+
+    No group is started once has_time() returns False when its turn in
+    the first stage comes, the titles of its entries are returned as not
+    saved. Episodes are recorded as pending with checkpoint() before
+    they are saved, and removed from it once indexed. Pass persist=False for entries already saved
+    that only need to be analyzed and indexed. When INDEXING is stream the
+    entries are only persisted."""
+    limits = {stage: threading.BoundedSemaphore(concurrency[stage])
+              for stage in ('persist', 'analyze', 'index')}
+    groups = [entries[start:start + INGEST_GROUP_SIZE]
+              for start in range(0, len(entries), INGEST_GROUP_SIZE)]
+    workers = sum(concurrency[stage] for stage in limits)
+    saved = []
+    tally = {'written': 0, 'retried': 0, 'failed': 0}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            lambda group: __ingest_group(group, limits, has_time, persist),
+            groups)
+        for group, (group_saved, writes) in zip(groups, results):
+            saved.extend(group_saved)
+            for key, value in writes.tally().items():
+                tally[key] += value
+            saved_titles = set(entry['title'] for entry in group_saved)
+            failed.update(entry['title'] for entry in group
+                          if entry['title'] not in saved_titles)
+    return saved, tally, failed
+
+def __ingest_group(group, limits, has_time, persist):
+    """Runs a group of entries through the persist, analyze and index
+    stages, holding the limit of each stage while in it"""
+    writes = WriteBuffer(DDB_TABLE)
+    if persist:
+        with limits['persist'], metrics.stage('persist'):
+            # Checked once the group's turn comes, as every group is queued
+            # at once
+            if not has_time():
+                return [], writes
+            if INDEXING != 'stream':
+                # Recorded before the writes, so an episode saved by a run
+                # that stops before indexing it is resumed by the next one.
+                # resume() drops the titles that were never saved.
+                checkpoint([entry['title'] for entry in group], 'pending')
+            for entry in group:
+                writes.put(ddb_item(entry))
+            writes.flush()
+        failed = set(item['title']['S'] for item in writes.failed)
+        saved = [entry for entry in group if entry['title'] not in failed]
+        if INDEXING == 'stream':
+            # Indexed by stream.main from the stream of the table
+            return saved, writes
     else:
-        return True
+        saved = group
+    with limits['analyze'], metrics.stage('analyze'):
+        if not persist and not has_time():
+            return [], writes
+        # analyze descriptions with comprehend
+        try:
+            documents, unanalyzed = analyze_entries(saved)
+        except Exception as error:
+            # Any error, of Comprehend or of the analysis cache once the
+            # retry budget is spent, the episodes are left pending in the
+            # checkpoint and resumed by the next run
+            print('Problem analyzing {} episodes: {}'.format(
+                len(saved), error))
+            return saved, writes
+    # Episodes Comprehend failed on are left pending for the next run
+    analyzed = [entry['title'] for entry in saved
+                if entry['title'] not in unanalyzed]
+    errors = []
+    if documents:
+        with limits['index'], metrics.stage('index'):
+            try:
+                _, errors = bulk_index(documents)
+            except Exception as error:
+                # Any error of the client, the episodes are left pending in
+                # the checkpoint and resumed by the next run
+                print('Problem indexing {} episodes: {}'.format(
+                    len(saved), error))
+                errors = documents
+    if not errors:
+        checkpoint(analyzed, 'indexed')
+    return saved, writes
 
 def main(event, context):
-    """Calls the HBR IdeaCast RSS feed and parses all of the entries. For each
+    """Calls the HBR IdeaCast RSS feed and parses its entries, as they are
+    read with rss.parse() unless FEED_PARSER says otherwise. For each
     entry found, checks if we already saved this episode, and if not, adds it
-    to DynamoDB, analyzes it with Comprehend, and sends the results to
-    Elasticsearch. """
-    feed = feedparser.parse(FEED_URL)
-    total_added = 0
-    try:
-        total_to_add = int(event['max'])
-    except KeyError:
-        total_to_add = 10
-    for entry in reversed(feed['entries']):
-        if total_added == total_to_add:
+    to DynamoDB. The new entries are then analyzed with Comprehend in batches
+    and the results are sent to Elasticsearch in bulk, with the stages
+    running concurrently as described in ingest().
+
+    The feed is requested conditionally with the ETag and Last-Modified
+    headers of the previous run, and only entries newer than the last one
+    processed are considered. Pass 'full' in the event to ignore the saved
+    state and walk the whole feed.
+
+    With the indexing environment variable set to stream, entries are only
+    saved and stream.main analyzes and indexes them. Episodes saved but not
+    indexed by a previous run, or by stream.main, according to the
+    checkpoint, are analyzed and indexed first. No new group of entries is
+    started once less than STOP_MARGIN_MS is left to the invocation. Pass
+    'backfill' in the event to ingest the whole archive: each invocation
+    takes up to BACKFILL_WINDOW entries and the function invokes itself
+    again until it caught up with the feed.
+
+    Pass 'backfill_episodes' in the event to only set the episode number on
+    the episodes saved without one, 'reindex' to only move the
+    Elasticsearch documents into an index with the explicit mapping,
+    'rebuild_index' to only index every episode again from the analysis
+    cache, 'rebuild_title_index' to only build the title index again from
+    the episodes of the table, or 'publish_snapshot' to only publish the
+    snapshot of the catalog."""
+    metrics.start('feed', 'ingest')
+    limiter.start()
+    try:
+        ingest_feed(event, context)
+    finally:
+        metrics.emit()
+
+def ingest_feed(event, context):
+    """Runs the ingest described in main()"""
+    if event.get('backfill_episodes'):
+        backfill_episode_numbers()
+        return
+    if event.get('reindex'):
+        reindex()
+        return
+    if event.get('rebuild_index'):
+        rebuild_index()
+        return
+    if event.get('rebuild_title_index'):
+        rebuild_title_index()
+        return
+    if event.get('publish_snapshot'):
+        generation = new_generation()
+        publish_snapshot(generation)
+        save_generation(generation)
+        return
+    if event.get('full'):
+        state = {}
+    else:
+        state = get_feed_state()
+    if event.get('backfill'):
+        total_to_add = BACKFILL_WINDOW
+    else:
+        try:
+            total_to_add = int(event['max'])
+        except KeyError:
+            total_to_add = 10
+    concurrency = dict(STAGE_CONCURRENCY)
+    concurrency.update(event.get('concurrency', {}))
+    index = None
+    index_size = 0
+    with metrics.stage('fetch'), metrics.timed('feed', 'parse'):
+        feed = fetch_feed(state)
+        if feed.get('status') == 304:
+            pending, known = [], set()
+        else:
+            index = load_title_index() if DEDUP_INDEX else None
+            index_size = len(index) if index is not None else 0
+
+            def lookup(titles):
+                with metrics.stage('dedup'):
+                    return added_titles(titles, index, concurrency['dedup'])
+
+            # Streamed entries are parsed here, up to the last one processed,
+            # and looked up as they come
+            pending, known = new_entries(feed['entries'], state,
+                                         total_to_add, lookup)
+    has_time = lambda: __time_left(context) > STOP_MARGIN_MS
+    resumed = resume(concurrency, has_time)
+    if feed.get('status') == 304:
+        print('Feed not modified since the last run')
+        if resumed:
+            publish_generation(resumed, has_time)
+        return
+    to_add = []
+    processed = 0
+    for entry in pending:
+        if len(to_add) == total_to_add:
             break
-        if already_added(entry['title']):
+        if entry['title'] in known:
+            processed += 1
             continue
+        if 'content' not in entry:
+            # Reduced by new_entries, it is left for the next run
+            break
+        processed += 1
+        to_add.append(entry)
+        known.add(entry['title'])
+    if to_add and INDEXING == 'inline':
+        ensure_index()
+    added, tally, failed = ingest(to_add, concurrency, has_time)
+    print('DynamoDB writes: {}'.format(json.dumps(tally)))
+    if failed:
+        # Pick up from the first entry that wasn't saved, or wasn't started
+        # for lack of time, on the next run
+        processed = min(i for i, entry in enumerate(pending)
+                        if entry['title'] in failed)
+    if index is not None:
+        for entry in added:
+            add_to_title_index(index, entry['title'])
+    if added:
+        update_latest(added)
+        update_title_search(added)
+    if processed:
+        state['last_guid'] = entry_guid(pending[processed - 1])
+        state['last_published'] = pending[processed - 1]['published']
+    if processed == len(pending):
+        # Caught up with the feed, the next run can be conditional
+        state['etag'] = feed.get('etag')
+        state['modified'] = feed.get('modified')
+    else:
+        state.pop('etag', None)
+        state.pop('modified', None)
+    save_feed_state(state)
+    if index is not None and len(index) != index_size:
+        save_title_index(index)
+    if added or resumed:
+        publish_generation(added + resumed, has_time)
+    if event.get('backfill') and processed < len(pending):
+        continue_backfill(event, context)
+
+def resume(concurrency, has_time):
+    """Analyzes and indexes the episodes a previous run saved but didn't
+    index, and those stream.main failed to index. Returns the entries it
+    went through, indexed or not."""
+    stages = load_checkpoint()
+    if not stages:
+        return []
+    print('Resuming {} episodes from the checkpoint'.format(len(stages)))
+    entries = []
+    for title in sorted(stages):
+        entry = saved_entry(title)
+        if entry is None:
+            checkpoint([title], 'indexed')
         else:
-            # add to DDB
-            add_to_ddb(entry)
-            # analyze description with comprehend
-            analyze(entry)
-            total_added += 1
\ No newline at end of file
+            entries.append(entry)
+    if entries:
+        ensure_index()
+    resumed, _, _ = ingest(entries, concurrency, has_time, persist=False)
+    return resumed
+
+def continue_backfill(event, context):
+    """Invokes this function again, asynchronously, to continue the
+    backfill where this invocation stopped"""
+    invocation = int(event.get('invocation', 0)) + 1
+    if context is None or invocation > BACKFILL_MAX_INVOCATIONS:
+        print('Backfill stopped after {} invocations'.format(invocation))
+        return
+    print('Continuing the backfill in invocation {}'.format(invocation))
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(dict(event, invocation=invocation))
+    )
+
+def __time_left(context):
+    """Returns the milliseconds left to the invocation"""
+    if context is None:
+        return float('inf')
+    return context.get_remaining_time_in_millis()
@@ -0,0 +1,142 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Global variables passed in as environment variables
+# Set verbose to true to print the detailed progress of the handlers
+VERBOSE = os.environ.get('verbose', 'false').lower() == 'true'
+# Share of invocations printing full request and response payloads
+PAYLOAD_SAMPLE_RATE = float(os.environ.get('payload_sample_rate', '0.01'))
+# Set metrics to false to stop printing the summary of each invocation
+METRICS = os.environ.get('metrics', 'true').lower() == 'true'
+NAMESPACE = 'HBRFeedcast'
+
+
+class Metrics(object):
+    """Records the latency and number of calls made to external services
+    during one invocation of a handler. Each call is tagged with the stage
+    it was made in, which defaults to the tag of the invocation (the intent
+    for the skill). emit() prints a single line in the CloudWatch embedded
+    metric format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start(None, None)
+
+    def start(self, function, tag):
+        """Starts recording a new invocation"""
+        with self.lock:
+            self.function = function
+            self.tag = tag
+            self.started = time.time()
+            self.calls = {}
+            self.sampled = VERBOSE or random.random() < PAYLOAD_SAMPLE_RATE
+
+    @contextmanager
+    def stage(self, name):
+        """Tags the calls made by this thread with the stage name"""
+        previous = getattr(self.local, 'stage', None)
+        self.local.stage = name
+        try:
+            yield
+        finally:
+            self.local.stage = previous
+
+    @contextmanager
+    def timed(self, service, operation):
+        """Records the latency of the call made in the with block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(service, operation, time.time() - start)
+
+    def record(self, service, operation, seconds):
+        """Records a call to the operation of service that took seconds"""
+        stage = getattr(self.local, 'stage', None) or self.tag
+        key = '{}.{}.{}'.format(stage, service, operation)
+        with self.lock:
+            count, total = self.calls.get(key, (0, 0.0))
+            self.calls[key] = (count + 1, total + seconds)
+
+    def instrument(self, client):
+        """Records every call made by a boto3 client"""
+        events = client.meta.events
+        events.register('before-call', self.__before_call)
+        events.register('after-call', self.__after_call)
+        return client
+
+    def instrument_es(self, client):
+        """Records every request made by an Elasticsearch client, the
+        operation being the first path component starting with an underscore
+        (_bulk, _search...) or the HTTP method"""
+        perform_request = client.transport.perform_request
+
+        def timed_request(method, url, *args, **kwargs):
+            operations = [part[1:] for part in url.split('?')[0].split('/')
+                          if part.startswith('_')]
+            with self.timed('es', operations[0] if operations else method):
+                return perform_request(method, url, *args, **kwargs)
+
+        client.transport.perform_request = timed_request
+        return client
+
+    def summary(self):
+        """Returns the recorded metrics in the embedded metric format"""
+        with self.lock:
+            calls = dict(self.calls)
+        line = {
+            '_aws': {
+                'Timestamp': int(self.started * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Function', 'Tag']],
+                    'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+                }]
+            },
+            'Function': self.function,
+            'Tag': self.tag,
+            'Duration': round((time.time() - self.started) * 1000, 1)
+        }
+        definitions = line['_aws']['CloudWatchMetrics'][0]['Metrics']
+        for key, (count, total) in sorted(calls.items()):
+            line[key + '.Calls'] = count
+            line[key + '.Latency'] = round(total * 1000, 1)
+            definitions.append({'Name': key + '.Calls', 'Unit': 'Count'})
+            definitions.append({'Name': key + '.Latency',
+                                'Unit': 'Milliseconds'})
+        return line
+
+    def emit(self):
+        """Prints the summary line of the invocation"""
+        if METRICS:
+            print(json.dumps(self.summary(), separators=(',', ':')))
+
+    def __before_call(self, context, **kwargs):
+        context['metrics_start'] = time.time()
+
+    def __after_call(self, model, context, **kwargs):
+        if 'metrics_start' in context:
+            self.record(model.service_model.service_name, model.name,
+                        time.time() - context['metrics_start'])
+
+
+# Shared by every module of the handler
+metrics = Metrics()
+
+
+def log(message):
+    """Prints the message only when verbose is enabled"""
+    if VERBOSE:
+        print(message)
+
+
+def dump(label, payload):
+    """Prints a payload for the invocations sampled by PAYLOAD_SAMPLE_RATE,
+    or all of them when verbose is enabled"""
+    if metrics.sampled:
+        print('{}: {}'.format(label, json.dumps(payload, default=str)))
@@ -0,0 +1,97 @@
+import gzip
+import xml.etree.ElementTree as ET
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}encoded'
+ITUNES_AUTHOR = '{http://www.itunes.com/dtds/podcast-1.0.dtd}author'
+DC_CREATOR = '{http://purl.org/dc/elements/1.1/}creator'
+# Seconds to wait for the feed server
+TIMEOUT = 30
+# Bytes read from the response at a time
+READ_SIZE = 64 * 1024
+
+
+def parse(url, etag=None, modified=None):
+    """Requests the feed at url, conditionally when given the ETag or
+    Last-Modified header of a previous response. Returns a dict shaped like
+    the result of feedparser.parse(): the status, etag and modified headers,
+    and the entries, a generator parsing the items of the response as it is
+    read.
+
+    Each entry is a dict holding only the id, title, link, author, published
+    and content of an item, with the same keys as feedparser. Items are
+    dropped from the tree once yielded, and the response is closed when the
+    generator is closed or stops, so stopping early skips the rest of the
+    download."""
+    headers = {'Accept-Encoding': 'gzip', 'User-Agent': 'hbr-feedcast'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=TIMEOUT)
+    except HTTPError as error:
+        if error.code != 304:
+            raise
+        error.close()
+        return {'status': 304, 'etag': etag, 'modified': modified,
+                'entries': iter(())}
+    return {
+        'status': response.status,
+        'etag': response.headers.get('ETag'),
+        'modified': response.headers.get('Last-Modified'),
+        'entries': entries(response)
+    }
+
+
+def entries(response):
+    """Yields the entries of an RSS response, see parse()"""
+    try:
+        source = response
+        if response.headers.get('Content-Encoding') == 'gzip':
+            source = gzip.GzipFile(fileobj=response)
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        channel = None
+        default_author = ''
+        while True:
+            data = source.read(READ_SIZE)
+            if not data:
+                break
+            parser.feed(data)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if element.tag == 'channel':
+                        channel = element
+                    continue
+                if element.tag == 'item':
+                    yield entry(element, default_author)
+                    # The channel would otherwise keep every item
+                    if channel is not None:
+                        channel.remove(element)
+                elif element.tag in ('title', ITUNES_AUTHOR) and \
+                        channel is not None and element in list(channel):
+                    if element.tag == ITUNES_AUTHOR or not default_author:
+                        default_author = (element.text or '').strip()
+        parser.close()
+    finally:
+        response.close()
+
+
+def entry(item, default_author=''):
+    """Returns the entry of an item element"""
+    def text(*tags):
+        for tag in tags:
+            value = item.findtext(tag)
+            if value:
+                return value.strip()
+        return ''
+
+    return {
+        'id': text('guid'),
+        'title': text('title'),
+        'link': text('link'),
+        'author': text('author', ITUNES_AUTHOR, DC_CREATOR) or default_author,
+        'published': text('pubDate'),
+        'content': [{'value': text(CONTENT, 'description')}]
+    }
@@ -0,0 +1,167 @@
+import gzip
+import json
+import re
+
+from titles import TitleIndex
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def words(text):
+    """Returns the lower case words of text, as the standard analyzer of
+    Elasticsearch splits them"""
+    return WORD.findall(text.lower())
+
+
+class Snapshot(object):
+    """Every episode of the catalog with the indexes the skill needs to
+    answer without a backend: the episodes by number, the title search
+    index and an inverted index of the entities by word. Built by feed.main
+    after each ingest and published as one compressed JSON document that the
+    skill loads once per version."""
+
+    def __init__(self, version, episodes, entities, numbers=None,
+                 titles=None, postings=None):
+        # [title, episode number, pub_date, pub_time, content], newest first
+        self.version = version
+        self.episodes = episodes
+        # [Text, is a person, Score, position of the episode]
+        self.entities = entities
+        if numbers is None:
+            numbers = {}
+            for position, episode in enumerate(episodes):
+                numbers.setdefault(episode[1], position)
+        self.numbers = numbers
+        if titles is None:
+            titles = TitleIndex(sorted(episode[0] for episode in episodes))
+        self.titles = titles
+        if postings is None:
+            postings = {}
+            for position, entity in enumerate(entities):
+                for word in set(words(entity[0])):
+                    postings.setdefault(word, []).append(position)
+        self.postings = postings
+        self.by_title = {episode[0]: position
+                         for position, episode in enumerate(episodes)}
+
+    @classmethod
+    def build(cls, version, episodes):
+        """Returns the snapshot of the episodes, a list of dicts holding the
+        title, episode, pub_date, pub_time and content of each episode along
+        with its entities, as filtered for Elasticsearch"""
+        ordered = sorted(episodes, key=lambda k: (k['pub_date'], k['pub_time']),
+                         reverse=True)
+        rows = []
+        entities = []
+        for position, episode in enumerate(ordered):
+            rows.append([episode['title'], episode.get('episode'),
+                         episode['pub_date'], episode['pub_time'],
+                         episode['content']])
+            for entity in episode['entities']:
+                entities.append([entity['Text'], entity['Type'] == 'PERSON',
+                                 round(float(entity['Score']), 4), position])
+        return cls(version, rows, entities)
+
+    def extend(self, version, episodes):
+        """Returns a new snapshot holding the episodes of this one along
+        with episodes, dicts as build() takes them, which replace the
+        episodes with the same title"""
+        added = Snapshot.build(version, episodes)
+        merged = []
+        for snapshot in (self, added):
+            entities = {}
+            for entity in snapshot.entities:
+                entities.setdefault(entity[3], []).append(entity)
+            merged.extend(
+                (episode, entities.get(position, []))
+                for position, episode in enumerate(snapshot.episodes)
+                if snapshot is added or episode[0] not in added.by_title)
+        merged.sort(key=lambda k: (k[0][2], k[0][3]), reverse=True)
+        rows = []
+        entities = []
+        for position, (episode, episode_entities) in enumerate(merged):
+            rows.append(episode)
+            entities.extend([entity[0], entity[1], entity[2], position]
+                            for entity in episode_entities)
+        return Snapshot(version, rows, entities)
+
+    def unanalyzed(self):
+        """Returns the episodes with no entities, as dicts like build()
+        takes them, without their entities"""
+        analyzed = set(entity[3] for entity in self.entities)
+        return [{'title': episode[0], 'episode': episode[1],
+                 'pub_date': episode[2], 'pub_time': episode[3],
+                 'content': episode[4]}
+                for position, episode in enumerate(self.episodes)
+                if position not in analyzed]
+
+    def latest(self, count):
+        """Returns the newest count episodes as dicts with their title"""
+        return [{'title': episode[0]} for episode in self.episodes[:count]]
+
+    def content(self, title):
+        """Returns the description of the episode with this title, or None"""
+        position = self.by_title.get(title)
+        return None if position is None else self.episodes[position][4]
+
+    def episode(self, number):
+        """Returns the description of the episode with this number, or
+        None"""
+        position = self.numbers.get(str(number))
+        return None if position is None else self.episodes[position][4]
+
+    def search(self, text, person, size):
+        """Returns up to size episodes with entities holding every word of
+        text, either people or anything but people, as dicts with the entity
+        Text and the episode title, along with the number of episodes
+        matching. Each episode is ranked by its best entity, the one with
+        the fewest other words then the most confident, and then by how
+        recent it is."""
+        found = None
+        for word in set(words(text)):
+            matches = set(self.postings.get(word, ()))
+            found = matches if found is None else found & matches
+            if not found:
+                return [], 0
+        if found is None:
+            return [], 0
+        best = {}
+        for position in found:
+            entity = self.entities[position]
+            if entity[1] != person:
+                continue
+            rank = (len(words(entity[0])), -entity[2], entity[3])
+            if entity[3] not in best or rank < best[entity[3]][0]:
+                best[entity[3]] = (rank, entity)
+        ranked = sorted(best.values(), key=lambda k: k[0])
+        return [{'Text': entity[0], 'title': self.episodes[entity[3]][0]}
+                for _, entity in ranked[:size]], len(ranked)
+
+    def dumps(self):
+        """Returns the snapshot as compressed JSON"""
+        return gzip.compress(json.dumps({
+            'version': self.version,
+            'episodes': self.episodes,
+            'entities': self.entities,
+            'numbers': self.numbers,
+            'titles': {
+                'titles': self.titles.titles,
+                'postings': self.titles.postings,
+                'sizes': self.titles.sizes
+            },
+            'postings': self.postings
+        }, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def loads(cls, data):
+        """Returns the snapshot saved by dumps()"""
+        saved = json.loads(gzip.decompress(data).decode('utf-8'))
+        titles = saved['titles']
+        return cls(saved['version'], saved['episodes'], saved['entities'],
+                   saved['numbers'], TitleIndex(titles['titles'],
+                                                titles['postings'],
+                                                titles['sizes']),
+                   saved['postings'])
+
+    def __len__(self):
+        return len(self.episodes)
@@ -0,0 +1,104 @@
+from boto3.dynamodb.types import TypeDeserializer
+import feed
+from metrics import metrics
+from throttle import limiter
+
+deserializer = TypeDeserializer()
+
+# Attributes of an episode its documents depend on. A change to any other
+# attribute (the episode number backfill...) doesn't need indexing again.
+INDEXED_ATTRIBUTES = ('title', 'published', 'content')
+
+
+def main(event, context):
+    """Called with a batch of records of the DynamoDB stream of the table.
+    The episodes inserted, or whose indexed attributes changed, are analyzed
+    with Comprehend and indexed in Elasticsearch in a single pass. Other
+    items of the table (the feed state, the title index...) are ignored.
+
+    Returns the records that failed as batchItemFailures, so the event source
+    mapping, with ReportBatchItemFailures, only retries from the first of
+    them. Their episodes are also recorded as pending in the checkpoint of
+    feed.main, which indexes them on its next run. The snapshot of the
+    catalog is published again with the entities of the episodes indexed.
+    Run it locally with the recorded records of stream-event.json."""
+    metrics.start('stream', 'index')
+    limiter.start()
+    try:
+        pending = []
+        for record in event['Records']:
+            entry = record_entry(record)
+            if entry is not None:
+                pending.append((record, entry))
+        print('Indexing {} of {} records'.format(
+            len(pending), len(event['Records'])))
+        failed = index_records(pending)
+        # Once the event source mapping gives up on them the records are
+        # dropped, feed.main picks the episodes up from the checkpoint
+        feed.checkpoint(sorted(set(
+            entry['title'] for record, entry in pending
+            if record in failed)), 'pending')
+        indexed = [entry for record, entry in pending if record not in failed]
+        if indexed:
+            # feed.main published these episodes before they were analyzed,
+            # the snapshot and the cached responses of the skill are renewed
+            feed.publish_generation(indexed)
+        return {
+            'batchItemFailures': [
+                {'itemIdentifier': record['dynamodb']['SequenceNumber']}
+                for record in failed
+            ]
+        }
+    finally:
+        metrics.emit()
+
+
+def record_entry(record):
+    """Returns the episode of a stream record in the shape of a feed entry,
+    or None if the record doesn't need indexing"""
+    if record['eventName'] == 'REMOVE':
+        return None
+    change = record['dynamodb']
+    image = change.get('NewImage', {})
+    if 'pub_date' not in image or 'content' not in image:
+        return None
+    old_image = change.get('OldImage')
+    if old_image is not None and all(
+            old_image.get(name) == image.get(name)
+            for name in INDEXED_ATTRIBUTES):
+        return None
+    return feed.entry_from_item(
+        {name: deserializer.deserialize(value)
+         for name, value in image.items()})
+
+
+def index_records(pending):
+    """Analyzes and indexes the episodes of a list of (record, entry) pairs.
+    Returns the records that failed. When the batch raises an error it is
+    split in two and each half is tried again, so a single bad record can't
+    fail the records around it."""
+    if not pending:
+        return []
+    entries = [entry for _, entry in pending]
+    try:
+        with metrics.stage('analyze'):
+            documents, unanalyzed = feed.analyze_entries(entries)
+        failed = []
+        if documents:
+            with metrics.stage('index'):
+                feed.ensure_index()
+                _, failed = feed.bulk_index(documents)
+    except Exception as error:
+        # Any error, so the records that can be indexed still are
+        if len(pending) == 1:
+            print('Problem indexing {}: {}'.format(entries[0]['title'], error))
+            return [pending[0][0]]
+        middle = len(pending) // 2
+        print('Problem indexing {} episodes, splitting the batch: {}'.format(
+            len(pending), error))
+        return index_records(pending[:middle]) + \
+            index_records(pending[middle:])
+    failed_titles = set(document['title'] for document in failed)
+    failed_titles.update(unanalyzed)
+    return [record for record, entry in pending
+            if entry['title'] in failed_titles]
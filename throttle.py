@@ -0,0 +1,313 @@
+import os
+import random
+import threading
+import time
+
+from botocore.config import Config
+from botocore.exceptions import HTTPClientError
+from metrics import metrics, log
+
+# Global variables passed in as environment variables
+# Provisioned read and write capacity units of each DynamoDB table
+READ_CAPACITY = float(os.environ.get('rcu', 1))
+WRITE_CAPACITY = float(os.environ.get('wcu', 1))
+# Requests per second allowed by the BatchDetectEntities quota
+COMPREHEND_RATE = float(os.environ.get('comprehend_rate', 10))
+# Requests per second sent to the Elasticsearch domain
+ES_RATE = float(os.environ.get('es_rate', 20))
+# Retries one invocation may spend, across every service
+RETRY_BUDGET = int(os.environ.get('retrybudget', 100))
+
+# Seconds of unused capacity a DynamoDB table can burst with, the buckets
+# start full. Other services get a second of their rate.
+DDB_BURST_SECONDS = 300
+# The rate of a bucket is multiplied by DECREASE on a throttle, at most once
+# per DECREASE_INTERVAL seconds as the calls in flight are throttled
+# together, and never below MIN_SHARE of its configured rate. It climbs back
+# by INCREASE of the configured rate per second.
+DECREASE = 0.5
+DECREASE_INTERVAL = 1.0
+MIN_SHARE = 0.1
+INCREASE = 0.05
+# Attempts of a single call, the first one included
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 10
+
+# Error codes of the AWS services meaning the caller is over its capacity
+THROTTLE_CODES = (
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'ThrottlingException', 'Throttling', 'TooManyRequestsException',
+    'SlowDown', 'RequestThrottled'
+)
+# HTTP statuses worth retrying, 429 being a throttle
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DDB_READS = ('GetItem', 'BatchGetItem', 'Query', 'Scan')
+DDB_WRITES = ('PutItem', 'UpdateItem', 'DeleteItem', 'BatchWriteItem')
+
+# Clients leave their retries to the limiter
+CLIENT_CONFIG = Config(retries={'total_max_attempts': 1})
+
+
+def backoff_delay(attempt):
+    """Returns a jittered exponential delay before the given attempt"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket(object):
+    """Paces calls to rate units per second, letting up to burst units go
+    at once. A call larger than what is left borrows from the tokens to
+    come, so the next calls wait for it. The rate is adjusted with AIMD:
+    throttled() cuts it, and it grows back linearly up to the configured
+    rate."""
+
+    def __init__(self, rate, burst):
+        self.ceiling = rate
+        self.floor = rate * MIN_SHARE
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.decreased = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """Takes cost tokens, sleeping until they are there. Returns the
+        seconds waited."""
+        with self.lock:
+            self.__refill()
+            self.tokens -= cost
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def take(self, cost=1):
+        """Takes cost tokens if they are there, without waiting. Returns
+        False if there aren't enough."""
+        with self.lock:
+            self.__refill()
+            if self.tokens < cost:
+                return False
+            self.tokens -= cost
+            return True
+
+    def settle(self, cost):
+        """Takes cost more tokens, or gives them back if negative, once the
+        actual cost of a call is known"""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens - cost)
+
+    def throttled(self):
+        """Cuts the rate and drops the tokens left after a throttle"""
+        with self.lock:
+            self.__refill()
+            now = time.time()
+            if now - self.decreased < DECREASE_INTERVAL:
+                return
+            self.decreased = now
+            self.rate = max(self.floor, self.rate * DECREASE)
+            self.tokens = min(self.tokens, 0)
+
+    def __refill(self):
+        now = time.time()
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.rate = min(self.ceiling,
+                        self.rate + elapsed * INCREASE * self.ceiling)
+
+
+class Limiter(object):
+    """Paces the calls of the clients it instruments with a token bucket per
+    service, or per DynamoDB table and kind of capacity, and retries the
+    calls that were throttled or failed on the server side. Retries are
+    taken from a budget shared by the whole invocation, set with start(),
+    so a service that keeps failing can't hold the invocation until it
+    times out. Once the budget is spent errors are raised to the caller.
+
+    Waits are recorded by metrics as calls to the throttle service,
+    throttles as calls to the throttled service and backoffs as calls to the
+    retry service, each with the bucket name as operation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.start()
+
+    def start(self, retries=RETRY_BUDGET):
+        """Starts a new invocation with a budget of retries. The buckets
+        keep their rate from one invocation to the next."""
+        with self.lock:
+            self.retries = retries
+
+    def spend(self):
+        """Takes a retry from the budget. Returns False if there are none
+        left."""
+        with self.lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+        return True
+
+    def bucket(self, name):
+        """Returns the bucket of name, creating it the first time"""
+        with self.lock:
+            if name not in self.buckets:
+                rate, burst = self.__limits(name)
+                self.buckets[name] = TokenBucket(rate, burst)
+            return self.buckets[name]
+
+    def acquire(self, name, cost=1):
+        """Waits for cost tokens of the bucket name"""
+        wait = self.bucket(name).acquire(cost)
+        if wait:
+            metrics.record('throttle', name, wait)
+
+    def throttled(self, name):
+        """Tells the bucket name that a call was throttled"""
+        log('Throttled by {}'.format(name))
+        metrics.record('throttled', name, 0)
+        self.bucket(name).throttled()
+
+    def retry(self, name, attempt):
+        """Returns the seconds to wait before retrying a call to the bucket
+        name for the given attempt, or None if it shouldn't be retried"""
+        if attempt >= MAX_ATTEMPTS or not self.spend():
+            print('Not retrying {} after {} attempts'.format(name, attempt))
+            return None
+        delay = backoff_delay(attempt)
+        metrics.record('retry', name, delay)
+        return delay
+
+    def instrument(self, client):
+        """Paces and retries every call made by a boto3 client, which should
+        be built with CLIENT_CONFIG so botocore doesn't retry on its own"""
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+        if service == 'dynamodb':
+            events.register('provide-client-params.dynamodb',
+                            self.__consumed_capacity)
+        events.register('before-parameter-build.' + service,
+                        self.__before_call)
+        events.register_first('needs-retry.' + service, self.__needs_retry)
+        events.register('after-call.' + service, self.__after_call)
+        return client
+
+    def instrument_es(self, client):
+        """Paces the requests made by an Elasticsearch client with the es
+        bucket and retries those throttled or failed on the server side"""
+        perform_request = client.transport.perform_request
+
+        def limited_request(method, url, *args, **kwargs):
+            attempt = 1
+            while True:
+                self.acquire('es')
+                try:
+                    return perform_request(method, url, *args, **kwargs)
+                except Exception as error:
+                    status = getattr(error, 'status_code', None)
+                    if status not in RETRY_STATUSES:
+                        raise
+                    if status == 429:
+                        self.throttled('es')
+                    delay = self.retry('es', attempt)
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+                attempt += 1
+
+        client.transport.perform_request = limited_request
+        return client
+
+    def __limits(self, name):
+        """Returns the rate and burst of the bucket name"""
+        if name.startswith('dynamodb.'):
+            rate = READ_CAPACITY if name.endswith('.read') else WRITE_CAPACITY
+            return rate, rate * DDB_BURST_SECONDS
+        rate = {'comprehend': COMPREHEND_RATE, 'es': ES_RATE}.get(name)
+        if rate is None:
+            # No known quota, throttles still slow it down from here
+            rate = 100
+        return rate, rate
+
+    def __consumed_capacity(self, params, model, **kwargs):
+        if 'ReturnConsumedCapacity' in model.input_shape.members:
+            params.setdefault('ReturnConsumedCapacity', 'INDEXES')
+
+    def __before_call(self, params, model, context, **kwargs):
+        costs = self.__costs(model.service_model.service_name, model.name,
+                             params)
+        context['throttle'] = costs
+        for name, cost in costs.items():
+            self.acquire(name, cost)
+
+    def __costs(self, service, operation, params):
+        """Returns the estimated cost of a call in each bucket it uses. The
+        cost of DynamoDB calls is in capacity units, assuming 1 KB items,
+        and settled once the consumed capacity is known."""
+        if service != 'dynamodb':
+            return {service: 1}
+        if operation in ('BatchGetItem', 'BatchWriteItem'):
+            costs = {}
+            for table_name, requests in params['RequestItems'].items():
+                if operation == 'BatchWriteItem':
+                    costs['dynamodb.{}.write'.format(table_name)] = \
+                        len(requests)
+                else:
+                    costs['dynamodb.{}.read'.format(table_name)] = \
+                        len(requests['Keys']) / 2.0
+            return costs
+        if operation in DDB_WRITES:
+            return {'dynamodb.{}.write'.format(params['TableName']): 1}
+        if operation in DDB_READS:
+            return {'dynamodb.{}.read'.format(params['TableName']): 0.5}
+        return {}
+
+    def __needs_retry(self, response, operation, attempts, caught_exception,
+                      request_dict, **kwargs):
+        costs = request_dict.get('context', {}).get('throttle') or \
+            {operation.service_model.service_name: 1}
+        if caught_exception is not None:
+            if not isinstance(caught_exception, HTTPClientError):
+                return None
+        else:
+            http, parsed = response
+            if http.status_code < 300:
+                return None
+            code = parsed.get('Error', {}).get('Code')
+            if code in THROTTLE_CODES or http.status_code == 429:
+                for name in costs:
+                    self.throttled(name)
+            elif http.status_code not in RETRY_STATUSES:
+                return None
+        delay = self.retry(min(costs), attempts)
+        if delay is None:
+            return None
+        for name, cost in costs.items():
+            self.acquire(name, cost)
+        return delay
+
+    def __after_call(self, parsed, context, **kwargs):
+        consumed = parsed.get('ConsumedCapacity')
+        costs = context.get('throttle')
+        if not consumed or not costs:
+            return
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        kind = 'read' if any(name.endswith('.read') for name in costs) \
+            else 'write'
+        for capacity in consumed:
+            name = 'dynamodb.{}.{}'.format(capacity['TableName'], kind)
+            if name in costs:
+                # Each index has its own capacity, the busiest one binds
+                units = [capacity.get('Table', capacity).get(
+                    'CapacityUnits', 0)]
+                units.extend(
+                    index['CapacityUnits'] for index in capacity.get(
+                        'GlobalSecondaryIndexes', {}).values())
+                self.bucket(name).settle(max(units) - costs[name])
+
+
+# Shared by every module of the handler
+limiter = Limiter()
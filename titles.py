@@ -0,0 +1,98 @@
+import json
+import re
+import zlib
+
+# Words left out of the title index, they match nearly every title
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'for',
+    'from', 'how', 'in', 'is', 'it', 'of', 'on', 'or', 'the', 'to', 'what',
+    'when', 'why', 'with', 'you', 'your'
+))
+# Episode number in front of the titles of the feed, "648: Title"
+EPISODE_PREFIX = re.compile(r'^\s*\d+\s*:')
+WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def tokens(title):
+    """Returns the words of a title in lower case, without the episode
+    number, punctuation and stopwords. A title made only of stopwords
+    keeps them."""
+    words = WORD.findall(EPISODE_PREFIX.sub('', title).lower())
+    words = [word.replace("'", '') for word in words]
+    kept = [word for word in words if word not in STOPWORDS]
+    return kept or words
+
+
+def grams(title):
+    """Returns the set of trigrams of the words of a title, each word padded
+    with spaces so short words and word boundaries count"""
+    found = set()
+    for word in tokens(title):
+        padded = '  {} '.format(word)
+        for i in range(len(padded) - 2):
+            found.add(padded[i:i + 3])
+    return found
+
+
+class TitleIndex(object):
+    """Trigram postings of the episode titles. Matches are ranked by the
+    Dice coefficient of the trigrams of the query and of each title, so
+    misheard or partial titles still find their episode. Saved by feed.main
+    as a compressed item of the DynamoDB table and loaded by the skill."""
+
+    def __init__(self, titles=(), postings=None, sizes=None):
+        self.titles = list(titles)
+        if postings is None:
+            postings = {}
+            sizes = []
+            for position, title in enumerate(self.titles):
+                title_grams = grams(title)
+                sizes.append(len(title_grams))
+                for gram in title_grams:
+                    postings.setdefault(gram, []).append(position)
+        self.postings = postings
+        self.sizes = sizes
+
+    def add(self, titles):
+        """Returns a new index with the titles added. Returns this index if
+        they are all in it already."""
+        known = set(self.titles)
+        added = [title for title in titles if title not in known]
+        if not added:
+            return self
+        return TitleIndex(sorted(known.union(added)))
+
+    def match(self, query, limit=1, min_score=0.0):
+        """Returns up to limit (title, score) tuples, best first, scoring at
+        least min_score"""
+        query_grams = grams(query)
+        if not query_grams:
+            return []
+        common = {}
+        for gram in query_grams:
+            for position in self.postings.get(gram, ()):
+                common[position] = common.get(position, 0) + 1
+        scored = []
+        for position, count in common.items():
+            score = 2.0 * count / (len(query_grams) + self.sizes[position])
+            if score >= min_score:
+                scored.append((score, self.titles[position]))
+        scored.sort(key=lambda k: (-k[0], k[1]))
+        return [(title, score) for score, title in scored[:limit]]
+
+    def dumps(self):
+        """Returns the index compressed for the DynamoDB item"""
+        return zlib.compress(json.dumps({
+            'titles': self.titles,
+            'postings': self.postings,
+            'sizes': self.sizes
+        }, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def loads(cls, data):
+        """Returns the index saved by dumps()"""
+        saved = json.loads(zlib.decompress(data).decode('utf-8'))
+        return cls(saved['titles'], saved['postings'], saved['sizes'])
+
+    def __len__(self):
+        return len(self.titles)